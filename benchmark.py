@@ -0,0 +1,621 @@
+"""
+Бенчмарк tgdown без настоящего экспорта и интернета.
+
+Состоит из трех частей:
+    generate - синтетический экспорт Telegram (result.json + файлы вложений)
+    serve    - локальный HTTP-сервер, имитирующий сайты из ссылок: задержка,
+               ограничение скорости, HTML с <title>, content-disposition,
+               Range и доля ошибок
+    run      - сценарии, замеряющие шаги 1-3 по отдельности: сообщений/с,
+               файлов/с, МБ/с и пиковую память процесса
+
+Примеры:
+    python benchmark.py run --messages 20000
+    python benchmark.py run --scenario download --latency 0.05 --bandwidth 2
+    python benchmark.py generate --messages 1000 --out bench/export
+    python benchmark.py serve --port 8765 --error-rate 0.05
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+SCENARIOS = ["attachments", "links", "download"]
+
+# Доли типов ссылок в синтетическом экспорте по умолчанию
+DEFAULT_LINK_MIX = "html=0.4,file=0.3,cd=0.1,skip=0.15,error=0.05"
+
+# Блок случайных байт, из которого сервер собирает тела файлов
+_BLOCK = random.Random(0).randbytes(1024 * 1024)
+SEND_CHUNK = 64 * 1024
+
+
+def parse_mix(value):
+    """
+    Разбирает строку вида "html=0.4,file=0.3" в словарь долей.
+    """
+    mix = {}
+    for part in value.split(","):
+        if not part.strip():
+            continue
+        name, _, share = part.partition("=")
+        mix[name.strip()] = float(share)
+    unknown = set(mix) - {"html", "file", "cd", "skip", "error"}
+    if unknown:
+        raise ValueError(f"Неизвестные типы ссылок: {', '.join(sorted(unknown))}")
+    return mix
+
+
+# --- 1. Генератор экспорта ---
+
+
+def generate_export(
+    out_dir,
+    messages=10000,
+    attachment_share=0.3,
+    attachment_size=16 * 1024,
+    links_per_message=1.0,
+    link_mix=None,
+    repost_share=0.1,
+    months=12,
+    base_url="http://127.0.0.1:8765",
+    seed=0,
+):
+    """
+    Создает в out_dir синтетический экспорт: result.json и файлы вложений
+    в files/. Ссылки ведут на base_url (локальный сервер serve), ссылки
+    типа skip - на youtube.com и t.me.
+
+    repost_share - доля ссылок, повторяющих одну из уже встречавшихся.
+
+    Возвращает словарь со статистикой экспорта.
+    """
+    rng = random.Random(seed)
+    link_mix = link_mix or parse_mix(DEFAULT_LINK_MIX)
+    kinds = list(link_mix)
+    weights = [link_mix[k] for k in kinds]
+
+    files_dir = os.path.join(out_dir, "files")
+    os.makedirs(files_dir, exist_ok=True)
+
+    start = datetime(2024, 1, 1)
+    span = timedelta(days=30 * max(1, months))
+    stats = {"messages": messages, "attachments": 0, "links": 0, "bytes": 0}
+    seen_links = []
+
+    def make_link(n):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "html":
+            return f"{base_url}/page/{n}?utm_source=bench"
+        if kind == "file":
+            return f"{base_url}/file/{n}.zip"
+        if kind == "cd":
+            return f"{base_url}/cd/{n}"
+        if kind == "error":
+            return f"{base_url}/error/{n}"
+        return rng.choice(["https://youtube.com/watch?v=", "https://t.me/c/"]) + str(n)
+
+    with open(os.path.join(out_dir, "result.json"), "w", encoding="utf-8") as f:
+        f.write(
+            '{"name": "Benchmark", "type": "private_group", "id": 1, "messages": [\n'
+        )
+        for i in range(messages):
+            date = start + span * i / max(1, messages)
+            message = {
+                "id": i + 1,
+                "type": "message",
+                "date": date.isoformat(timespec="seconds"),
+                "from": "bench",
+                "text_entities": [{"type": "plain", "text": f"Сообщение {i + 1} "}],
+            }
+
+            if rng.random() < attachment_share:
+                name = f"file_{i + 1}.bin"
+                size = max(1, int(rng.expovariate(1 / attachment_size)))
+                with open(os.path.join(files_dir, name), "wb") as af:
+                    af.write(_BLOCK[:size] if size <= len(_BLOCK) else os.urandom(size))
+                message["file"] = f"files/{name}"
+                stats["attachments"] += 1
+                stats["bytes"] += size
+
+            count = int(links_per_message) + (
+                rng.random() < links_per_message - int(links_per_message)
+            )
+            for _ in range(count):
+                if seen_links and rng.random() < repost_share:
+                    url = rng.choice(seen_links)
+                else:
+                    url = make_link(len(seen_links) + 1)
+                    seen_links.append(url)
+                message["text_entities"].append({"type": "link", "text": url})
+                stats["links"] += 1
+
+            f.write(("," if i else "") + json.dumps(message, ensure_ascii=False) + "\n")
+        f.write("]}\n")
+    return stats
+
+
+# --- 2. Локальный HTTP-сервер ---
+
+
+class BenchHandler(BaseHTTPRequestHandler):
+    """
+    Обработчик запросов бенчмарка. Настройки берутся из self.server:
+    latency (с), bandwidth (байт/с на соединение, 0 - без ограничения),
+    error_rate, page_size, file_size.
+
+    Пути:
+        /page/<n>   HTML со своим <title>
+        /file/<n>   файл с Accept-Ranges, ETag и поддержкой Range
+        /cd/<n>     файл с именем в content-disposition
+        /error/<n>  всегда 404
+    С вероятностью error_rate любой запрос получает 503.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def handle_request(self, send_body):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+            fail = server.random.random() < server.error_rate
+
+        parsed = urlparse(self.path)
+        match = re.match(r"^/(page|file|cd|error)/(\d+)", parsed.path)
+        if fail or not match:
+            status = 503 if fail else 404
+            self.send_response(status)
+            if fail:
+                self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        kind, n = match.group(1), int(match.group(2))
+        if kind == "error":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if kind == "page":
+            title = f"Страница {n} — бенчмарк".encode("utf-8")
+            body = (
+                b'<html><head><meta charset="utf-8"><title>'
+                + title
+                + b"</title></head><body>"
+            )
+            body += b"x" * max(0, server.page_size - len(body)) + b"</body></html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.send_throttled(memoryview(body))
+            return
+
+        query = parse_qs(parsed.query)
+        size = int(query.get("size", [server.file_size])[0])
+        etag = f'"{n}-{size}"'
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and (not if_range or if_range == etag):
+            m = re.match(r"bytes=(\d+)-(\d*)", range_header)
+            if m:
+                start = int(m.group(1))
+                end = min(int(m.group(2)) if m.group(2) else size - 1, size - 1)
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        if kind == "cd":
+            self.send_header(
+                "Content-Disposition", f'attachment; filename="report-{n}.pdf"'
+            )
+        self.end_headers()
+        if send_body:
+            self.send_file_range(start, end + 1)
+
+    def send_file_range(self, start, end):
+        # Тело файла собирается из _BLOCK по смещению, без хранения файла
+        position = start
+        while position < end:
+            offset = position % len(_BLOCK)
+            size = min(SEND_CHUNK, end - position, len(_BLOCK) - offset)
+            self.send_throttled(memoryview(_BLOCK)[offset : offset + size])
+            position += size
+
+    def send_throttled(self, data):
+        bandwidth = self.server.bandwidth
+        for i in range(0, len(data), SEND_CHUNK):
+            chunk = data[i : i + SEND_CHUNK]
+            started = time.monotonic()
+            try:
+                self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            if bandwidth:
+                delay = len(chunk) / bandwidth - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+def start_server(
+    host="127.0.0.1",
+    port=0,
+    latency=0.0,
+    bandwidth=0,
+    error_rate=0.0,
+    page_size=64 * 1024,
+    file_size=256 * 1024,
+    seed=0,
+):
+    """
+    Запускает BenchHandler в фоновом потоке. Возвращает сервер;
+    адрес - server.server_address, остановка - server.shutdown().
+    """
+    server = ThreadingHTTPServer((host, port), BenchHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.bandwidth = bandwidth
+    server.error_rate = error_rate
+    server.page_size = page_size
+    server.file_size = file_size
+    server.random = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- 3. Сценарии ---
+
+
+def peak_rss_mb():
+    """
+    Пиковая память процесса в МБ или None, если платформа ее не сообщает.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux сообщает килобайты, macOS - байты
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def count_output(target_dir):
+    """
+    Число и суммарный размер файлов в папках месяцев.
+    """
+    files = 0
+    size = 0
+    for root, _, names in os.walk(target_dir):
+        if root == target_dir:
+            continue
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+def run_scenario(name, export_dir, target_dir, messages, options):
+    """
+    Выполняет один сценарий в текущем процессе и возвращает метрики.
+    Вывод downloader подавляется.
+    """
+    import downloader
+
+    downloader.configure_http(
+        retries=options.get("retries"), segments=options.get("segments")
+    )
+    kwargs = {
+        "attachments": {"collect_links": False, "download_files": False},
+        "links": {"collect_links": True, "download_files": False},
+        "download": {
+            "collect_links": False,
+            "download_files": True,
+            "jobs": options.get("jobs", downloader.DEFAULT_JOBS),
+            "per_host_jobs": options.get("per_host", downloader.DEFAULT_PER_HOST_JOBS),
+        },
+    }[name]
+
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        downloader.find_and_process_files(
+            os.path.join(export_dir, "result.json"), target_dir, **kwargs
+        )
+    elapsed = time.perf_counter() - started
+
+    files, size = count_output(target_dir)
+    if name == "links":
+        links_path = os.path.join(target_dir, "links.txt")
+        files = 1 if os.path.exists(links_path) else 0
+        size = os.path.getsize(links_path) if files else 0
+    return {
+        "scenario": name,
+        "messages": messages,
+        "seconds": round(elapsed, 3),
+        "messages_per_s": round(messages / elapsed, 1) if elapsed else None,
+        "files": files,
+        "files_per_s": round(files / elapsed, 1) if elapsed else None,
+        "mb": round(size / (1024 * 1024), 2),
+        "mb_per_s": round(size / (1024 * 1024) / elapsed, 2) if elapsed else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def scenario_export_options(name, args):
+    # Экспорт под шаг сценария: остальные шаги в нем не участвуют
+    link_mix = parse_mix(args.link_mix)
+    if name == "attachments":
+        return {"attachment_share": 1.0, "links_per_message": 0, "link_mix": link_mix}
+    if name == "links":
+        return {"attachment_share": 0.0, "links_per_message": 2.0, "link_mix": link_mix}
+    return {
+        "attachment_share": 0.0,
+        "links_per_message": args.links_per_message,
+        "link_mix": link_mix,
+    }
+
+
+def format_table(results):
+    columns = [
+        ("scenario", "Сценарий"),
+        ("messages_per_s", "Сообщ./с"),
+        ("files", "Файлов"),
+        ("files_per_s", "Файлов/с"),
+        ("mb_per_s", "МБ/с"),
+        ("seconds", "Время, с"),
+        ("peak_rss_mb", "Пик RSS, МБ"),
+    ]
+    rows = [[title for _, title in columns]]
+    for result in results:
+        rows.append(
+            [
+                f"{value:.1f}" if isinstance(value, float) else str(value)
+                for value in (result.get(key) for key, _ in columns)
+            ]
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join(
+        "  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows
+    )
+
+
+def run_benchmarks(args):
+    """
+    Генерирует экспорт для каждого сценария, поднимает локальный сервер
+    и запускает сценарии в отдельных процессах (чтобы пиковая память
+    считалась для каждого сценария отдельно).
+    """
+    scenarios = [args.scenario] if args.scenario else SCENARIOS
+    work_dir = tempfile.mkdtemp(prefix="tgdown-bench-")
+    server = start_server(
+        latency=args.latency,
+        bandwidth=int(args.bandwidth * 1024 * 1024),
+        error_rate=args.error_rate,
+        page_size=args.page_size,
+        file_size=args.file_size,
+    )
+    base_url = "http://%s:%d" % server.server_address
+    results = []
+    try:
+        for name in scenarios:
+            export_dir = os.path.join(work_dir, name, "export")
+            target_dir = os.path.join(work_dir, name, "out")
+            messages = args.download_messages if name == "download" else args.messages
+            generate_export(
+                export_dir,
+                messages=messages,
+                base_url=base_url,
+                attachment_size=args.attachment_size,
+                seed=args.seed,
+                **scenario_export_options(name, args),
+            )
+            options = {
+                "jobs": args.jobs,
+                "per_host": args.per_host,
+                "retries": args.retries,
+                "segments": args.segments,
+            }
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "_scenario",
+                    name,
+                    export_dir,
+                    target_dir,
+                    str(messages),
+                    json.dumps(options),
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{name}: {result['seconds']} с", file=sys.stderr)
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(format_table(results))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.json}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк tgdown")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_export_args(p):
+        p.add_argument("--messages", type=int, default=10000, help="Число сообщений")
+        p.add_argument(
+            "--attachment-size",
+            type=int,
+            default=16 * 1024,
+            help="Средний размер вложения, байт",
+        )
+        p.add_argument(
+            "--link-mix",
+            default=DEFAULT_LINK_MIX,
+            help=f"Доли типов ссылок (по умолчанию {DEFAULT_LINK_MIX})",
+        )
+        p.add_argument(
+            "--links-per-message",
+            type=float,
+            default=1.0,
+            help="Среднее число ссылок в сообщении",
+        )
+        p.add_argument("--seed", type=int, default=0)
+
+    def add_server_args(p):
+        p.add_argument("--latency", type=float, default=0.0, help="Задержка ответа, с")
+        p.add_argument(
+            "--bandwidth",
+            type=float,
+            default=0.0,
+            help="Скорость отдачи на соединение, МБ/с (0 - без ограничения)",
+        )
+        p.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 503")
+        p.add_argument(
+            "--page-size", type=int, default=64 * 1024, help="Размер HTML, байт"
+        )
+        p.add_argument(
+            "--file-size", type=int, default=256 * 1024, help="Размер файла, байт"
+        )
+
+    p = commands.add_parser("generate", help="Создать синтетический экспорт")
+    add_export_args(p)
+    p.add_argument(
+        "--attachments", type=float, default=0.3, help="Доля сообщений с вложением"
+    )
+    p.add_argument(
+        "--repost-share", type=float, default=0.1, help="Доля повторных ссылок"
+    )
+    p.add_argument("--base-url", default="http://127.0.0.1:8765")
+    p.add_argument("--out", required=True, help="Папка экспорта")
+
+    p = commands.add_parser("serve", help="Запустить локальный HTTP-сервер")
+    add_server_args(p)
+    p.add_argument("--port", type=int, default=8765)
+
+    p = commands.add_parser("run", help="Запустить сценарии")
+    add_export_args(p)
+    add_server_args(p)
+    p.add_argument("--scenario", choices=SCENARIOS, help="Только один сценарий")
+    p.add_argument(
+        "--download-messages",
+        type=int,
+        default=500,
+        help="Число сообщений в сценарии download",
+    )
+    p.add_argument("--jobs", type=int, default=8)
+    p.add_argument("--per-host", type=int, default=8)
+    p.add_argument("--retries", type=int, default=2)
+    p.add_argument("--segments", type=int, default=4)
+    p.add_argument("--json", help="Сохранить результаты в JSON-файл")
+    p.add_argument("--keep", action="store_true", help="Не удалять рабочую папку")
+
+    p = commands.add_parser("_scenario")  # внутренний: один сценарий в процессе
+    p.add_argument("name", choices=SCENARIOS)
+    p.add_argument("export_dir")
+    p.add_argument("target_dir")
+    p.add_argument("messages", type=int)
+    p.add_argument("options")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        stats = generate_export(
+            args.out,
+            messages=args.messages,
+            attachment_share=args.attachments,
+            attachment_size=args.attachment_size,
+            links_per_message=args.links_per_message,
+            link_mix=parse_mix(args.link_mix),
+            repost_share=args.repost_share,
+            base_url=args.base_url,
+            seed=args.seed,
+        )
+        print(
+            f"Экспорт создан в {args.out}: сообщений {stats['messages']}, "
+            f"вложений {stats['attachments']}, ссылок {stats['links']}"
+        )
+    elif args.command == "serve":
+        server = start_server(
+            port=args.port,
+            latency=args.latency,
+            bandwidth=int(args.bandwidth * 1024 * 1024),
+            error_rate=args.error_rate,
+            page_size=args.page_size,
+            file_size=args.file_size,
+        )
+        print(
+            "Сервер запущен: http://%s:%d (Ctrl+C - остановить)" % server.server_address
+        )
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.command == "_scenario":
+        result = run_scenario(
+            args.name,
+            args.export_dir,
+            args.target_dir,
+            args.messages,
+            json.loads(args.options),
+        )
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        run_benchmarks(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,411 +1,3791 @@
 import json
 import os
 import shutil
-import requests
+import codecs
+import threading
+import time
+import hashlib
+import sqlite3
 import argparse
 import re
-import yadisk
 import html
-from datetime import datetime
-from urllib.parse import urlparse
-from tqdm import tqdm
+import importlib
+import random
+import glob
+import contextlib
+import multiprocessing
+from email.utils import parsedate_to_datetime
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from urllib.parse import (
+    parse_qsl,
+    quote,
+    urlencode,
+    urljoin,
+    urlparse,
+    urlsplit,
+    urlunsplit,
+)
+
+
+class _LazyModule:
+    """
+    Модуль, который импортируется при первом обращении к его атрибуту.
+    Запуски без сети (только вложения или только сбор ссылок) не
+    загружают requests и yadisk.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+requests = _LazyModule("requests")
+urllib3 = _LazyModule("urllib3")
+yadisk = _LazyModule("yadisk")
+_tqdm = _LazyModule("tqdm")
+
+
+class _NoProgress:
+    """
+    Заглушка индикатора прогресса, если tqdm не установлен.
+    """
+
+    def __init__(self, *args, initial=0, **kwargs):
+        self.n = initial
+
+    def update(self, n=1):
+        self.n += n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def tqdm(*args, **kwargs):
+    """
+    Индикатор прогресса tqdm. Модуль импортируется при первом вызове;
+    без него работа идет без индикатора.
+    """
+    try:
+        return _tqdm.tqdm(*args, **kwargs)
+    except ImportError:
+        return _NoProgress(*args, **kwargs)
 
 
 # Список файлов, которые нужно игнорировать при скачивании
 IGNORED_FILES = ["Google Colab.html", "Launch Meeting - Zoom.html"]
 
-# Список доменов, которые пропускаются при скачивании
-SKIPPED_DOMAINS = ["youtube.com", "youtu.be", "t.me"]
+# Список доменов, которые пропускаются при скачивании
+SKIPPED_DOMAINS = ["youtube.com", "youtu.be", "t.me"]
+
+# Список ключей сообщения, которые могут содержать пути к локальным файлам
+ATTACHMENT_KEYS = [
+    "file",
+    "photo",
+    "video_file",
+    "voice_message",
+    "audio_file",
+    "sticker_emoji",
+]
+
+# Типы ссылок
+LINK_SKIP = "skip"  # Соцсети и видеохостинги: не скачиваются
+LINK_YANDEX = "yandex"  # Публичные файлы и папки Яндекс.Диска
+LINK_HTML = "html"  # Веб-страницы: сохраняются по <title>
+LINK_FILE = "file"  # Прямые ссылки на файлы
+
+# Правила классификации ссылок по умолчанию. Их можно переопределить
+# JSON-файлом с теми же ключами (--url-rules)
+DEFAULT_URL_RULES = {
+    # Домены сравниваются с хостом ссылки по суффиксу: "t.me" совпадает
+    # с "t.me" и "www.t.me", но не с "chat.medium.com"
+    "skip_domains": SKIPPED_DOMAINS,
+    "yandex_domains": ["disk.yandex.ru", "disk.yandex.com", "yadi.sk"],
+    # Хосты, ссылки на которые превращаются в прямые ссылки на файл
+    "gdrive_domains": ["drive.google.com"],
+    "dropbox_domains": ["dropbox.com"],
+    "html_domains": [
+        "docs.google.com",
+        "trafory.yonote.ru",
+        "zoom.us",
+        "github.com",
+        "habr.com",
+        "youtube.com",
+        "youtu.be",
+        "colab.research.google.com",
+    ],
+    "html_extensions": [".html", ".htm"],
+    # Фрагменты пути и URL, характерные для веб-страниц
+    "html_path_markers": ["/edit", "/view"],
+    "html_url_markers": ["sharing"],
+    "file_extensions": [
+        ".pdf",
+        ".doc",
+        ".docx",
+        ".xls",
+        ".xlsx",
+        ".zip",
+        ".rar",
+        ".mp4",
+        ".avi",
+        ".mkv",
+        ".mp3",
+        ".wav",
+        ".jpg",
+        ".png",
+        ".gif",
+    ],
+}
+
+# Число одновременных скачиваний: всего и с одного хоста
+DEFAULT_JOBS = 4
+DEFAULT_PER_HOST_JOBS = 2
+
+# Настройки общего HTTP-клиента
+DEFAULT_USER_AGENT = (
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/124.0 Safari/537.36 tgdown"
+)
+DEFAULT_POOL_CONNECTIONS = 32  # Сколько хостов держат пул соединений
+DEFAULT_POOL_MAXSIZE = DEFAULT_PER_HOST_JOBS  # Соединений на один хост
+
+# Таймауты HTTP (секунды): на установку соединения и между порциями данных
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+# Повторы при временных ошибках: экспоненциальная задержка со случайным
+# разбросом, Retry-After сервера имеет приоритет
+DEFAULT_RETRIES = 4
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_MAX = 60.0
+RETRY_AFTER_MAX = 300.0
+RETRY_STATUSES = frozenset([408, 425, 429, 500, 502, 503, 504])
+THROTTLE_STATUSES = frozenset([429, 503])
+
+# Ограничение частоты запросов к хосту, который начал отвечать 429/503:
+# по скольким последним запросам измеряется частота, частота по умолчанию
+# (если измерить не удалось), минимум и множитель восстановления
+HOST_RATE_WINDOW = 32
+HOST_RATE_START = 8.0
+HOST_RATE_MIN = 0.2
+HOST_RATE_GROWTH = 1.1
+# На сколько успешный ответ поднимает лимит одновременных скачиваний с хоста
+HOST_LIMIT_STEP = 0.25
+
+# Параметры отслеживания, которые удаляются из ссылок при нормализации
+TRACKING_PARAMS = frozenset(
+    ["fbclid", "gclid", "yclid", "ysclid", "igshid", "mc_cid", "mc_eid", "_openstat"]
+)
+TRACKING_PREFIXES = ("utm_",)
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Сокращатели ссылок: настоящий адрес узнается по редиректу
+SHORTENER_DOMAINS = frozenset(
+    [
+        "bit.ly",
+        "goo.gl",
+        "t.co",
+        "tinyurl.com",
+        "clck.ru",
+        "vk.cc",
+        "is.gd",
+        "ow.ly",
+        "cutt.ly",
+        "tiny.cc",
+    ]
+)
+MAX_SHORTENER_HOPS = 5
+
+# Буфер чтения тела ответа: растет от минимума до максимума, пока
+# чтения заполняют его целиком
+STREAM_BUFFER_MIN = 64 * 1024
+STREAM_BUFFER_MAX = 1024 * 1024
+
+# Сегментированное скачивание: большие файлы с Accept-Ranges качаются
+# несколькими соединениями, каждое в свой диапазон байт
+DEFAULT_SEGMENTS = 4
+SEGMENT_MIN_SIZE = 32 * 1024 * 1024  # Файлы меньше качаются одним потоком
+SEGMENT_MIN_PART = 8 * 1024 * 1024  # Минимальный размер одной части
+
+# Сколько первых байт HTML-страницы просматривается в поисках <title>
+TITLE_SCAN_BYTES = 64 * 1024
+# Размер порции при потоковом чтении страницы ради <title>
+TITLE_CHUNK_SIZE = 8 * 1024
+
+# Метрики запуска: JSON-сводка в целевой директории и границы
+# гистограммы задержек HTTP (секунды до получения заголовков ответа)
+METRICS_FILENAME = "metrics.json"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Файл манифеста в целевой директории: что уже скачано в прошлых запусках
+MANIFEST_FILENAME = "manifest.sqlite"
+
+# Индекс ссылок запуска (JSON Lines): пишется по мере обработки,
+# links.txt, skipped.txt и errors.txt строятся из него
+LINK_INDEX_FILENAME = "links.jsonl"
+
+# Суффиксы ключа отметки инкрементальной обработки для запусков без
+# скачивания: только сбор ссылок и только копирование вложений
+WATERMARK_LINKS_SUFFIX = "#links"
+WATERMARK_COPY_SUFFIX = "#attachments"
+
+# Режимы дедупликации одинаковых файлов
+DEDUP_MODES = ["hardlink", "reflink"]
+
+# Способы переноса вложений из экспорта и число потоков копирования
+ATTACHMENT_MODES = ["copy", "hardlink", "reflink", "symlink"]
+DEFAULT_COPY_JOBS = 8
+
+# ioctl FICLONE (Linux): reflink-копия файла без копирования данных
+FICLONE = 0x40049409
+
+# Публичные папки Яндекс.Диска: размер страницы листинга и число
+# одновременно скачиваемых файлов одной папки вне планировщика
+YANDEX_PAGE_SIZE = 200
+YANDEX_FOLDER_JOBS = 4
+
+# Недокачанные файлы: .tgdown-<хэш URL>.part и рядом .part.json с валидаторами
+PART_PREFIX = ".tgdown-"
+PART_SUFFIX = ".part"
+
+# .part файлы, которые прямо сейчас пишут загрузки
+_active_part_files = set()
+_part_files_lock = threading.Lock()
+
+
+def get_unique_filename(dest_path):
+    """
+    Возвращает уникальное имя файла, добавляя (01), (02) и т.д. при необходимости.
+    Занятые имена берутся из индекса директории, а не из os.path.exists.
+    """
+    return _filename_index.unique_name(dest_path)
+
+
+def reserve_unique_filename(dest_path):
+    """
+    Атомарно выбирает уникальное имя файла и резервирует его до вызова
+    release_filename, чтобы параллельные загрузки не получили одно имя.
+    """
+    return _filename_index.reserve_unique(dest_path)
+
+
+def reserve_part_filename(part_path):
+    """
+    Резервирует имя .part файла. В отличие от reserve_unique_filename,
+    уже существующий на диске .part файл не считается занятым: его нужно
+    докачать. Другое имя выбирается, только если этот .part файл прямо
+    сейчас пишет другая загрузка.
+    """
+    with _part_files_lock:
+        base_path, ext = os.path.splitext(part_path)
+        path = part_path
+        counter = 1
+        while path in _active_part_files:
+            path = f"{base_path} ({counter:02d}){ext}"
+            counter += 1
+        _active_part_files.add(path)
+        return path
+
+
+def release_filename(path):
+    """
+    Снимает резерв с имени файла (файл уже записан или скачивание не удалось).
+    """
+    with _part_files_lock:
+        if path in _active_part_files:
+            _active_part_files.discard(path)
+            return
+    _filename_index.release(path)
+
+
+class _HostMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # последний - +Inf
+
+
+class Metrics:
+    """
+    Метрики одного запуска: время шагов, HTTP-статистика по хостам
+    (запросы, байты, гистограмма задержек, повторы, ошибки), время
+    чтения title и тел ответов, попадания в кэши.
+
+    Сохраняются в JSON (write_json) и в textfile для Prometheus
+    node_exporter (write_prometheus).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}  # шаг -> секунды
+        self.busy = {}  # шаг -> [выполняемых задач, начало работы]
+        self.hosts = {}  # хост -> _HostMetrics
+        self.timers = {"title": 0.0, "body": 0.0}
+        self.caches = {}  # кэш -> [попадания, промахи]
+        self.counters = {}
+
+    def _host(self, host):
+        # Вызывается под self.lock
+        metrics = self.hosts.get(host)
+        if metrics is None:
+            metrics = self.hosts[host] = _HostMetrics()
+        return metrics
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def task_started(self, name):
+        """
+        Отмечает начало задачи шага, который идет на пуле потоков
+        параллельно с другими. Время такого шага - время, когда
+        выполнялась хотя бы одна его задача.
+        """
+        with self.lock:
+            busy = self.busy.setdefault(name, [0, 0.0])
+            if not busy[0]:
+                busy[1] = time.monotonic()
+            busy[0] += 1
+
+    def task_finished(self, name):
+        with self.lock:
+            busy = self.busy[name]
+            busy[0] -= 1
+            if not busy[0]:
+                seconds = time.monotonic() - busy[1]
+                self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def request(self, host, latency, error=False):
+        with self.lock:
+            metrics = self._host(host)
+            metrics.requests += 1
+            metrics.errors += error
+            metrics.latency_sum += latency
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    break
+            else:
+                i = len(LATENCY_BUCKETS)
+            metrics.latency_buckets[i] += 1
+
+    def add_bytes(self, host, size):
+        with self.lock:
+            self._host(host).bytes += size
+
+    def retry(self, host):
+        with self.lock:
+            self._host(host).retries += 1
+
+    def cache(self, name, hit):
+        with self.lock:
+            counts = self.caches.setdefault(name, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def summary(self):
+        """
+        Метрики в виде словаря (для JSON).
+        """
+        with self.lock:
+            hosts = {}
+            for host, m in sorted(self.hosts.items()):
+                buckets = {}
+                total = 0
+                for bound, value in zip(
+                    [str(b) for b in LATENCY_BUCKETS] + ["+Inf"], m.latency_buckets
+                ):
+                    total += value
+                    buckets[bound] = total
+                hosts[host] = {
+                    "requests": m.requests,
+                    "bytes": m.bytes,
+                    "retries": m.retries,
+                    "errors": m.errors,
+                    "latency_seconds_sum": round(m.latency_sum, 3),
+                    "latency_buckets": buckets,
+                }
+            caches = {
+                name: {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": (
+                        round(hits / (hits + misses), 3) if hits + misses else None
+                    ),
+                }
+                for name, (hits, misses) in sorted(self.caches.items())
+            }
+            return {
+                "started": datetime.fromtimestamp(self.started).isoformat(
+                    timespec="seconds"
+                ),
+                "wall_seconds": round(time.time() - self.started, 3),
+                "phases": {k: round(v, 3) for k, v in self.phases.items()},
+                "title_seconds": round(self.timers["title"], 3),
+                "body_seconds": round(self.timers["body"], 3),
+                "counters": dict(self.counters),
+                "caches": caches,
+                "hosts": hosts,
+            }
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+
+    def write_prometheus(self, path):
+        """
+        Пишет метрики в формате textfile collector. Файл заменяется
+        атомарно, чтобы node_exporter не прочитал его наполовину.
+        """
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP tgdown_{name} {help_text}")
+            lines.append(f"# TYPE tgdown_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"tgdown_{name}{_prometheus_labels(labels)} {value}")
+
+        metric(
+            "wall_seconds", "gauge", "Run wall time.", [({}, summary["wall_seconds"])]
+        )
+        metric(
+            "last_run_timestamp_seconds",
+            "gauge",
+            "Run start time.",
+            [({}, round(self.started, 3))],
+        )
+        metric(
+            "phase_seconds",
+            "gauge",
+            "Wall time per step.",
+            [({"phase": k}, v) for k, v in summary["phases"].items()],
+        )
+        metric(
+            "fetch_seconds",
+            "gauge",
+            "Time spent fetching titles and bodies.",
+            [
+                ({"part": "title"}, summary["title_seconds"]),
+                ({"part": "body"}, summary["body_seconds"]),
+            ],
+        )
+        metric(
+            "events_total",
+            "counter",
+            "Run counters.",
+            [({"event": k}, v) for k, v in summary["counters"].items()],
+        )
+        metric(
+            "cache_hits_total",
+            "counter",
+            "Cache hits.",
+            [({"cache": k}, v["hits"]) for k, v in summary["caches"].items()],
+        )
+        metric(
+            "cache_misses_total",
+            "counter",
+            "Cache misses.",
+            [({"cache": k}, v["misses"]) for k, v in summary["caches"].items()],
+        )
+        hosts = summary["hosts"]
+        for name, key, help_text in (
+            ("http_requests_total", "requests", "HTTP requests per host."),
+            ("http_bytes_total", "bytes", "Body bytes received per host."),
+            ("http_retries_total", "retries", "Retried requests per host."),
+            ("http_errors_total", "errors", "Failed requests per host."),
+        ):
+            metric(
+                name,
+                "counter",
+                help_text,
+                [({"host": h}, m[key]) for h, m in hosts.items()],
+            )
+        lines.append(
+            "# HELP tgdown_http_latency_seconds Time to response headers per host."
+        )
+        lines.append("# TYPE tgdown_http_latency_seconds histogram")
+        for host, m in hosts.items():
+            for bound, value in m["latency_buckets"].items():
+                labels = _prometheus_labels({"host": host, "le": bound})
+                lines.append(f"tgdown_http_latency_seconds_bucket{labels} {value}")
+            labels = _prometheus_labels({"host": host})
+            lines.append(
+                f"tgdown_http_latency_seconds_sum{labels} {m['latency_seconds_sum']}"
+            )
+            lines.append(f"tgdown_http_latency_seconds_count{labels} {m['requests']}")
+
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+    def print_summary(self):
+        summary = self.summary()
+        phases = ", ".join(f"{k} {v:.1f} с" for k, v in summary["phases"].items())
+        print(f"Время шагов: {phases}")
+        requests_count = sum(m["requests"] for m in summary["hosts"].values())
+        if requests_count:
+            received = sum(m["bytes"] for m in summary["hosts"].values())
+            print(
+                f"HTTP: запросов {requests_count} к {len(summary['hosts'])} хостам, "
+                f"получено {format_file_size(received)}; "
+                f"title {summary['title_seconds']:.1f} с, "
+                f"тела {summary['body_seconds']:.1f} с"
+            )
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+# Метрики текущего запуска (пересоздаются в find_and_process_files)
+_metrics = Metrics()
+
+
+class _HostState:
+    def __init__(self):
+        self.rate = None  # запросов в секунду; None - без ограничения
+        self.ceiling = None  # частота до замедления: выше нее ограничение снимается
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.limit = None  # одновременных скачиваний; None - без ограничения
+        self.cap = DEFAULT_PER_HOST_JOBS
+
+
+class HostThrottle:
+    """
+    Адаптивное ограничение нагрузки на хосты.
+
+    Для каждого хоста - корзина токенов на частоту запросов и лимит
+    одновременных скачиваний. Пока хост отвечает нормально, ограничений
+    нет. Ответ 429 (или 503 с Retry-After) вдвое снижает измеренную
+    частоту запросов и параллельность и приостанавливает хост на
+    Retry-After, каждый успешный ответ возвращает их обратно в
+    HOST_RATE_GROWTH раз. 503 без Retry-After обычно случайный сбой:
+    его обрабатывают только повторы запроса.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}  # хост -> _HostState
+        self.requests = {}  # хост -> время последних запросов
+        self.throttled = 0
+
+    def _state(self, host):
+        # Вызывается под self.lock
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = _HostState()
+        return state
+
+    def _measured_rate(self, host):
+        # Вызывается под self.lock
+        times = self.requests.get(host)
+        if not times or len(times) < 2 or times[-1] <= times[0]:
+            return None
+        return (len(times) - 1) / (times[-1] - times[0])
+
+    def acquire(self, host):
+        """
+        Ждет разрешения на очередной запрос к хосту.
+        """
+        with self.lock:
+            times = self.requests.get(host)
+            if times is None:
+                times = self.requests[host] = deque(maxlen=HOST_RATE_WINDOW)
+            times.append(time.monotonic())
+            state = self.hosts.get(host)
+            if state is None:
+                return
+            now = time.monotonic()
+            wait = max(0.0, state.paused_until - now)
+            if state.rate:
+                burst = max(1.0, state.rate)
+                state.tokens = min(
+                    burst, state.tokens + (now - state.updated) * state.rate
+                )
+                state.updated = now
+                # Токен берется сразу, даже в долг: следующий запрос
+                # подождет дольше
+                state.tokens -= 1
+                if state.tokens < 0:
+                    wait = max(wait, -state.tokens / state.rate)
+        if wait:
+            time.sleep(wait)
+
+    def concurrency(self, host, cap):
+        """
+        Сколько скачиваний с хоста можно вести одновременно (не больше cap).
+        """
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                return cap
+            state.cap = cap
+            if state.limit is None:
+                return cap
+            return max(1, min(cap, int(state.limit)))
+
+    def feedback(self, host, status, retry_after=None):
+        """
+        Учитывает ответ хоста: 429 и 503 с Retry-After снижают нагрузку,
+        успешные ответы постепенно ее восстанавливают.
+        """
+        with self.lock:
+            if status == 429 or (status in THROTTLE_STATUSES and retry_after):
+                state = self._state(host)
+                self.throttled += 1
+                rate = state.rate or self._measured_rate(host) or HOST_RATE_START
+                if not state.rate:
+                    state.ceiling = rate
+                state.rate = max(HOST_RATE_MIN, rate / 2)
+                state.tokens = min(state.tokens, 0.0)
+                state.updated = time.monotonic()
+                state.limit = max(1.0, (state.limit or state.cap) / 2)
+                if retry_after:
+                    state.paused_until = time.monotonic() + retry_after
+                return
+            state = self.hosts.get(host)
+            if state is None or status >= 500:
+                return
+            if state.rate:
+                state.rate *= HOST_RATE_GROWTH
+                if state.rate >= state.ceiling:
+                    state.rate = None
+            if state.limit:
+                state.limit += HOST_LIMIT_STEP
+                if state.limit >= state.cap:
+                    state.limit = None
+            if state.rate is None and state.limit is None:
+                # Хост восстановился
+                del self.hosts[host]
+
+
+_host_throttle = HostThrottle()
+
+# Общий для процессов пакетной обработки лимит одновременных скачиваний
+# (семафор multiprocessing); None - только лимит планировщика
+_download_budget = None
+
+# Планировщик, задачу которого выполняет текущий поток
+_scheduler_context = threading.local()
+
+
+class DownloadScheduler:
+    """
+    Планировщик параллельных скачиваний с общим лимитом потоков
+    и отдельным лимитом на каждый хост.
+
+    Задачи хоста, исчерпавшего свой лимит, ждут в его очереди и не занимают
+    рабочие потоки, поэтому медленный хост не блокирует остальные.
+    При пакетной обработке задача дополнительно занимает место в общем
+    для всех процессов бюджете скачиваний (_download_budget).
+    """
+
+    def __init__(self, jobs=DEFAULT_JOBS, per_host_jobs=DEFAULT_PER_HOST_JOBS):
+        self.jobs = max(1, jobs)
+        self.per_host_jobs = max(1, per_host_jobs)
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self.lock = threading.Condition()
+        self.queues = {}  # хост -> очередь ожидающих задач
+        self.active = {}  # хост -> число выполняющихся задач
+        self.pending = 0
+        # Ограничиваем число задач в очередях, чтобы не читать экспорт
+        # намного быстрее, чем идут скачивания
+        self.max_pending = self.jobs * 64
+
+    @staticmethod
+    def current():
+        """
+        Возвращает (планировщик, хост) задачи, выполняемой в этом потоке,
+        или (None, None) вне рабочих потоков планировщика.
+        """
+        return getattr(_scheduler_context, "task", (None, None))
+
+    def submit(self, host, func, wait=True):
+        with self.lock:
+            while wait and self.pending >= self.max_pending:
+                self.lock.wait()
+            self.pending += 1
+            self.queues.setdefault(host, deque()).append(func)
+            self._dispatch(host)
+
+    def _dispatch(self, host):
+        # Вызывается под self.lock
+        queue = self.queues.get(host)
+        limit = _host_throttle.concurrency(host, self.per_host_jobs)
+        while queue and self.active.get(host, 0) < limit:
+            func = queue.popleft()
+            self.active[host] = self.active.get(host, 0) + 1
+            self.executor.submit(self._run, host, func)
+        if not queue:
+            self.queues.pop(host, None)
+
+    def _run(self, host, func):
+        budget = _download_budget
+        _scheduler_context.task = (self, host)
+        try:
+            if budget is not None:
+                budget.acquire()
+            _metrics.task_started("downloads")
+            try:
+                func()
+            finally:
+                _metrics.task_finished("downloads")
+                if budget is not None:
+                    budget.release()
+        except Exception as e:
+            print(f"Ошибка в задаче скачивания ({host}): {e}")
+        finally:
+            del _scheduler_context.task
+            with self.lock:
+                self.active[host] -= 1
+                if not self.active[host]:
+                    del self.active[host]
+                self.pending -= 1
+                self._dispatch(host)
+                self.lock.notify_all()
+
+    def join(self):
+        """
+        Дожидается завершения всех задач и останавливает рабочие потоки.
+        """
+        with self.lock:
+            while self.pending:
+                self.lock.wait()
+        self.executor.shutdown(wait=True)
+
+    def _unqueue(self, host, func):
+        # Вызывается под self.lock: убирает еще не отправленную в пул задачу
+        # из очереди хоста. Возвращает True, если задача была в очереди
+        queue = self.queues.get(host)
+        if not queue or func not in queue:
+            return False
+        queue.remove(func)
+        if not queue:
+            self.queues.pop(host, None)
+        self.pending -= 1
+        return True
+
+
+class TaskGroup:
+    """
+    Вложенные задачи одного хоста, например файлы публичной папки.
+
+    Задачи идут через очереди планировщика и соблюдают его лимиты
+    (--jobs, --per-host, общий бюджет пакетной обработки). Поток,
+    ожидающий группу, сам выполняет ее задачи, которые еще не начаты -
+    и в очереди хоста, и уже отправленные в пул, но не получившие поток
+    или место в бюджете. Поэтому группа не ждет потоков, которые сама
+    же и занимает.
+    """
+
+    def __init__(self, scheduler, host, max_pending):
+        self.scheduler = scheduler
+        self.host = host
+        self.max_pending = max(1, max_pending)
+        self.waiting = {}  # еще не начатые задачи: обертка -> функция
+        self.running = 0
+
+    def submit(self, func):
+        scheduler = self.scheduler
+
+        def run():
+            # Задачу мог уже выполнить поток, ожидающий группу
+            with scheduler.lock:
+                if self.waiting.pop(run, None) is None:
+                    return
+                self.running += 1
+            try:
+                func()
+            finally:
+                with scheduler.lock:
+                    self.running -= 1
+                    scheduler.lock.notify_all()
+
+        with scheduler.lock:
+            self.waiting[run] = func
+        # Без ожидания общей очереди: ее освобождают и задачи этой группы
+        scheduler.submit(self.host, run, wait=False)
+        while len(self.waiting) + self.running >= self.max_pending:
+            self._step()
+
+    def join(self):
+        while self.waiting or self.running:
+            self._step()
+
+    def _step(self):
+        scheduler = self.scheduler
+        with scheduler.lock:
+            if not self.waiting:
+                if self.running:
+                    scheduler.lock.wait()
+                return
+            run = next(iter(self.waiting))
+            func = self.waiting.pop(run)
+            self.running += 1
+            scheduler._unqueue(self.host, run)
+        # Задача выполняется в потоке, который уже занимает место хоста
+        # и общего бюджета, поэтому лимиты не меняются
+        try:
+            func()
+        except Exception as e:
+            print(f"Ошибка в задаче скачивания ({self.host}): {e}")
+        finally:
+            with scheduler.lock:
+                self.running -= 1
+                scheduler.lock.notify_all()
+
+
+class Manifest:
+    """
+    Постоянный манифест скачиваний (SQLite) в целевой директории.
+
+    Для каждой пары (URL, id сообщения) хранит итоговый путь, размер,
+    SHA-256, HTTP-валидаторы и статус. При повторном запуске успешно
+    скачанные ссылки пропускаются, а ошибки скачиваются заново.
+
+    Отдельно для каждого URL хранится кэш ревалидации (url_cache): файл,
+    валидаторы и время последней проверки. По нему ссылку можно
+    перепроверить условным запросом, не скачивая тело.
+
+    Для инкрементальной обработки хранится отметка каждого чата
+    (watermarks): id и дата последнего обработанного сообщения.
+    """
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.used = {}  # URL -> время обращения, еще не записанное в url_cache
+        if read_only:
+            # Только чтение (--plan): файл манифеста не меняется
+            self.conn = sqlite3.connect(
+                f"file:{quote(os.path.abspath(path))}?mode=ro",
+                uri=True,
+                check_same_thread=False,
+            )
+            return
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS downloads (
+                url TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                month TEXT,
+                status TEXT NOT NULL,
+                path TEXT,
+                size INTEGER,
+                sha256 TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                updated_at TEXT,
+                PRIMARY KEY (url, message_id)
+            ) WITHOUT ROWID
+            """
+        )
+        # Индекс содержимого для дедупликации: хэш -> первый файл с ним
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER
+            ) WITHOUT ROWID
+            """
+        )
+        # Манифест прошлой версии: кэш ревалидации заполняется из downloads
+        # один раз, дальше валидаторы хранятся только в url_cache
+        has_url_cache = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'url_cache'"
+        ).fetchone()
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS url_cache (
+                url TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER,
+                sha256 TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                checked_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        if not has_url_cache:
+            self._import_url_cache()
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS watermarks (
+                chat TEXT PRIMARY KEY,
+                name TEXT,
+                message_id INTEGER NOT NULL,
+                date TEXT,
+                updated_at TEXT
+            )
+            """
+        )
+        self.conn.commit()
+
+    def get(self, url, message_id):
+        """
+        Возвращает запись манифеста в виде словаря или None.
+        """
+        with self.lock:
+            cursor = self.conn.execute(
+                "SELECT * FROM downloads WHERE url = ? AND message_id = ?",
+                (url, message_id),
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([c[0] for c in cursor.description], row))
+
+    def is_done(self, url, message_id):
+        """
+        Проверяет, была ли ссылка обработана в прошлых запусках:
+        скачана (и файл все еще на месте) или проигнорирована.
+        """
+        entry = self.get(url, message_id)
+        if entry is None:
+            return False
+        if entry["status"] == "ignored":
+            return True
+        return (
+            entry["status"] == "done"
+            and bool(entry["path"])
+            and os.path.exists(entry["path"])
+        )
+
+    def record(self, url, message_id, month, status, path=None, info=None):
+        """
+        Сохраняет результат обработки ссылки.
+        """
+        info = info or {}
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO downloads (
+                    url, message_id, month, status, path, size,
+                    sha256, etag, last_modified, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    url,
+                    message_id,
+                    month,
+                    status,
+                    path,
+                    info.get("size"),
+                    info.get("sha256"),
+                    info.get("etag"),
+                    info.get("last_modified"),
+                    datetime.now().isoformat(timespec="seconds"),
+                ),
+            )
+            self.conn.commit()
+
+    def forget_blob(self, path):
+        """
+        Забывает содержимое файла path: файл будет перезаписан.
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM blobs WHERE path = ?", (path,))
+            self.conn.commit()
+
+    def claim_blob(self, sha256, path, size):
+        """
+        Возвращает путь к уже сохраненному файлу с тем же содержимым.
+        Если такого нет (или он пропал с диска), регистрирует path
+        и возвращает его.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT path, size FROM blobs WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+            if row and row[0] != path and row[1] == size and os.path.exists(row[0]):
+                return row[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO blobs (sha256, path, size) VALUES (?, ?, ?)",
+                (sha256, path, size),
+            )
+            self.conn.commit()
+            return path
+
+    def _import_url_cache(self):
+        # Последняя успешная загрузка каждого URL из таблицы downloads
+        rows = self.conn.execute(
+            """
+            SELECT url, path, size, sha256, etag, last_modified, updated_at
+            FROM downloads WHERE status = 'done' AND path IS NOT NULL
+            ORDER BY updated_at
+            """
+        ).fetchall()
+        for url, path, size, sha256, etag, last_modified, updated_at in rows:
+            try:
+                checked_at = datetime.fromisoformat(updated_at).timestamp()
+            except (TypeError, ValueError):
+                checked_at = 0.0
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO url_cache (
+                    url, path, size, sha256, etag, last_modified, checked_at, used_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (url, path, size, sha256, etag, last_modified, checked_at, checked_at),
+            )
+        self.conn.commit()
+
+    def cached(self, url):
+        """
+        Запись кэша ревалидации для URL или None (нет записи или файл
+        пропал с диска).
+        """
+        with self.lock:
+            cursor = self.conn.execute("SELECT * FROM url_cache WHERE url = ?", (url,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            entry = dict(zip([c[0] for c in cursor.description], row))
+            self.used[url] = time.time()
+        if not os.path.exists(entry["path"]):
+            return None
+        return entry
+
+    def remember(self, url, path, info=None):
+        """
+        Сохраняет файл и валидаторы URL после скачивания или успешной
+        перепроверки.
+        """
+        info = info or {}
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO url_cache (
+                    url, path, size, sha256, etag, last_modified, checked_at, used_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    url,
+                    path,
+                    info.get("size"),
+                    info.get("sha256"),
+                    info.get("etag"),
+                    info.get("last_modified"),
+                    now,
+                    now,
+                ),
+            )
+            self.conn.commit()
+            self.used.pop(url, None)
+
+    def evict(self, max_entries):
+        """
+        Оставляет в кэше ревалидации max_entries записей, к которым
+        обращались последними (LRU). Возвращает число удаленных записей.
+        """
+        with self.lock:
+            self._flush_used()
+            cursor = self.conn.execute(
+                """
+                DELETE FROM url_cache WHERE url IN (
+                    SELECT url FROM url_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (max(0, max_entries),),
+            )
+            self.conn.commit()
+            return cursor.rowcount
+
+    def watermark(self, chat):
+        """
+        Id последнего обработанного сообщения чата или None.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT message_id FROM watermarks WHERE chat = ?", (chat,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, chat, name, message_id, date):
+        """
+        Сохраняет отметку чата: сообщения с id не больше message_id
+        при инкрементальной обработке пропускаются.
+        """
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO watermarks (
+                    chat, name, message_id, date, updated_at
+                ) VALUES (?, ?, ?, ?, ?)
+                """,
+                (
+                    chat,
+                    name,
+                    message_id,
+                    date,
+                    datetime.now().isoformat(timespec="seconds"),
+                ),
+            )
+            self.conn.commit()
+
+    def _flush_used(self):
+        # Вызывается под self.lock: время обращений пишется одной пачкой
+        if self.used:
+            self.conn.executemany(
+                "UPDATE url_cache SET used_at = ? WHERE url = ?",
+                [(used_at, url) for url, used_at in self.used.items()],
+            )
+            self.conn.commit()
+            self.used.clear()
+
+    def close(self):
+        with self.lock:
+            self._flush_used()
+            self.conn.close()
+
+
+def link_file(source_path, dest_path, mode):
+    """
+    Создает dest_path как ссылку на source_path.
+
+    mode: "hardlink" - жесткая ссылка, "reflink" - копия с общими блоками
+    (copy-on-write, Btrfs/XFS), "symlink" - символическая ссылка,
+    "copy" - обычная копия. При неудаче выбрасывается OSError.
+    """
+    if mode == "hardlink":
+        os.link(source_path, dest_path)
+    elif mode == "symlink":
+        os.symlink(os.path.abspath(source_path), dest_path)
+    elif mode == "reflink":
+        try:
+            import fcntl
+        except ImportError:
+            raise OSError("reflink не поддерживается на этой платформе")
+        with open(source_path, "rb") as src, open(dest_path, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                dst.close()
+                os.remove(dest_path)
+                raise
+        shutil.copystat(source_path, dest_path)
+    else:
+        shutil.copy2(source_path, dest_path)
+
+
+class FilenameIndex:
+    """
+    Индекс имен файлов по директориям. Каждая директория читается через
+    os.scandir один раз, дальше проверки имен идут по памяти, а индекс
+    обновляется по мере создания файлов. Выбор и резервирование имени
+    атомарны, поэтому параллельные загрузки не получат один суффикс (NN).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listings = {}  # директория -> множество имен в ней
+        self.added = set()  # пути, занятые в этом запуске
+        self.pending = set()  # зарезервированные, но еще не записанные пути
+
+    def _listing(self, dir_path):
+        # Вызывается под self.lock
+        names = self.listings.get(dir_path)
+        if names is None:
+            try:
+                with os.scandir(dir_path) as it:
+                    names = {entry.name for entry in it}
+            except FileNotFoundError:
+                names = set()
+            self.listings[dir_path] = names
+        return names
+
+    def ensure_dir(self, dir_path):
+        """
+        Создает директорию, если она еще не создавалась в этом запуске.
+        """
+        with self.lock:
+            if dir_path in self.listings:
+                return
+        os.makedirs(dir_path, exist_ok=True)
+        with self.lock:
+            self._listing(dir_path)
+
+    def forget(self, dir_path):
+        """
+        Забывает директорию и ее подпапки, например после переименования.
+        """
+        prefix = os.path.join(dir_path, "")
+        with self.lock:
+            for path in list(self.listings):
+                if path == dir_path or path.startswith(prefix):
+                    del self.listings[path]
+
+    def exists(self, path):
+        dir_path, name = os.path.split(path)
+        with self.lock:
+            return name in self._listing(dir_path)
+
+    def existed_before(self, path):
+        """
+        Проверяет, был ли файл на диске до начала запуска.
+        """
+        return self.exists(path) and path not in self.added
+
+    def unique_name(self, dest_path):
+        with self.lock:
+            return self._unique_name(dest_path)
+
+    def _unique_name(self, dest_path):
+        # Вызывается под self.lock
+        dir_path, name = os.path.split(dest_path)
+        names = self._listing(dir_path)
+        base_name, ext = os.path.splitext(name)
+        candidates = [name] + [
+            f"{base_name} ({counter:02d}){ext}" for counter in range(1, 100)
+        ]  # Ограничение до (99)
+        for candidate in candidates:
+            if candidate in names:
+                continue
+            path = os.path.join(dir_path, candidate)
+            # Файл мог появиться в обход индекса - проверяем только
+            # выбранное имя, а не каждое по очереди
+            if os.path.exists(path):
+                names.add(candidate)
+                continue
+            return path
+
+        # Если дошли до 100, используем timestamp
+        timestamp = int(time.time())
+        while f"{base_name} ({timestamp}){ext}" in names:
+            timestamp += 1
+        return os.path.join(dir_path, f"{base_name} ({timestamp}){ext}")
+
+    def reserve_unique(self, dest_path):
+        with self.lock:
+            path = self._unique_name(dest_path)
+            dir_path, name = os.path.split(path)
+            self._listing(dir_path).add(name)
+            self.added.add(path)
+            self.pending.add(path)
+            return path
+
+    def release(self, path):
+        """
+        Снимает резерв. Если файл так и не был записан, имя освобождается.
+        """
+        exists = os.path.exists(path)
+        with self.lock:
+            self.pending.discard(path)
+            if not exists:
+                dir_path, name = os.path.split(path)
+                self.listings.get(dir_path, set()).discard(name)
+                self.added.discard(path)
+
+
+# Общий индекс имен для вложений и скачиваний
+_filename_index = FilenameIndex()
+
+
+class AttachmentMaterializer:
+    """
+    Переносит вложения из экспорта в папки месяцев на пуле потоков.
+
+    Вложения копируются или связываются ссылками (mode из ATTACHMENT_MODES).
+    Если ссылку создать нельзя (другая файловая система, нет поддержки
+    reflink), файл копируется.
+    """
+
+    def __init__(self, mode="copy", jobs=DEFAULT_COPY_JOBS, deduplicator=None):
+        self.mode = mode
+        self.deduplicator = deduplicator
+        self.executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        # Ограничиваем число задач в очереди пула
+        self.slots = threading.BoundedSemaphore(max(1, jobs) * 16)
+        self.dirs = _filename_index
+        self.claimed = set()  # имена, уже занятые вложениями в этом запуске
+        self.lock = threading.Lock()
+        self.done = 0
+        self.fallbacks = 0
+        self.failed = 0
+
+    def submit(self, source_path, dest_dir, file_name):
+        # Исходный файл может отсутствовать, если экспорт был без медиа
+        if not self.dirs.exists(source_path):
+            return
+        self.dirs.ensure_dir(dest_dir)
+        dest_path = os.path.join(dest_dir, file_name)
+        # Копируем, только если файл еще не существует: остался с прошлого
+        # запуска или уже взят другим вложением
+        if dest_path in self.claimed or self.dirs.existed_before(dest_path):
+            return
+        self.claimed.add(dest_path)
+        # Скачивания идут одновременно с копированием: если имя уже занято
+        # скачанным файлом, вложение получит номер (01), (02)...
+        dest_path = reserve_unique_filename(dest_path)
+        self.slots.acquire()
+        self.executor.submit(self._run, source_path, dest_path)
+
+    def _run(self, source_path, dest_path):
+        _metrics.task_started("attachments")
+        try:
+            fallback = self._materialize(source_path, dest_path)
+            with self.lock:
+                self.done += 1
+                self.fallbacks += fallback
+        except Exception as e:
+            print(f"Ошибка копирования {source_path}: {e}")
+            with self.lock:
+                self.failed += 1
+        finally:
+            _metrics.task_finished("attachments")
+            release_filename(dest_path)
+            self.slots.release()
+
+    def _materialize(self, source_path, dest_path):
+        # Возвращает True, если пришлось скопировать вместо ссылки
+        if self.mode != "copy":
+            try:
+                link_file(source_path, dest_path, self.mode)
+                return False
+            except OSError:
+                pass
+        if self.deduplicator:
+            self.deduplicator.copy_file(source_path, dest_path)
+        else:
+            shutil.copy2(source_path, dest_path)
+        return self.mode != "copy"
+
+    def join(self):
+        self.executor.shutdown(wait=True)
+
+    def print_summary(self):
+        verb = "скопировано" if self.mode == "copy" else f"перенесено ({self.mode})"
+        print(f"Вложений {verb}: {self.done}")
+        if self.fallbacks:
+            print(f"Не удалось создать ссылку, скопировано: {self.fallbacks}")
+        if self.failed:
+            print(f"Ошибок копирования: {self.failed}")
+
+
+class Deduplicator:
+    """
+    Дедупликация по содержимому: файл, совпадающий по SHA-256 с уже
+    сохраненным, заменяется жесткой ссылкой или reflink-копией.
+    Индекс хэшей хранится в манифесте.
+    """
+
+    def __init__(self, index, mode="hardlink"):
+        self.index = index
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes_saved = 0
+
+    def dedupe(self, path, sha256, size):
+        """
+        Заменяет path ссылкой на файл с тем же содержимым, если он есть.
+        Возвращает путь к исходному файлу или None.
+        """
+        original = self.index.claim_blob(sha256, path, size)
+        if original == path:
+            return None
+
+        temp_path = path + ".tgdown-link"
+        try:
+            link_file(original, temp_path, self.mode)
+            os.replace(temp_path, path)
+        except OSError as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            print(f"Не удалось связать дубликат {path}: {e}")
+            return None
+
+        with self.lock:
+            self.files += 1
+            self.bytes_saved += size
+        return original
+
+    def copy_file(self, source_path, dest_path, chunk_size=1024 * 1024):
+        """
+        Копирует файл, считая SHA-256 по ходу копирования,
+        и сразу дедуплицирует копию.
+        """
+        hasher = hashlib.sha256()
+        size = 0
+        with open(source_path, "rb") as src, open(dest_path, "wb") as dst:
+            for chunk in iter(lambda: src.read(chunk_size), b""):
+                dst.write(chunk)
+                hasher.update(chunk)
+                size += len(chunk)
+        shutil.copystat(source_path, dest_path)
+        return self.dedupe(dest_path, hasher.hexdigest(), size)
+
+    def print_summary(self):
+        if self.files:
+            print(
+                f"Дедупликация: {self.files} дубликатов связано с уже сохраненными "
+                f"файлами, сэкономлено {format_file_size(self.bytes_saved)}"
+            )
+        else:
+            print("Дедупликация: дубликатов не найдено")
+
+
+# Ссылка из конкретного сообщения: url - канонический адрес,
+# kind - тип ссылки (LINK_*)
+LinkRef = namedtuple("LinkRef", "url message_id date month kind dest_dir")
+
+
+class _Resource:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.refs = []  # ссылки, ждущие завершения скачивания
+        self.result = None  # (success, path, info) после скачивания
+        self.placed = {}  # папка месяца -> путь к файлу ресурса в ней
+
+
+class LinkRegistry:
+    """
+    Реестр уникальных ресурсов запуска. Каждая каноническая ссылка
+    скачивается один раз; остальные сообщения с ней получают уже
+    скачанный файл: в той же папке месяца - тот же файл, в другой -
+    ссылку на него (mode, при неудаче копию). Результат записывается
+    в манифест для каждого сообщения.
+
+    on_result(ref, success, path, info) вызывается для каждой ссылки
+    по готовности.
+    """
+
+    def __init__(self, manifest=None, mode="copy", on_result=None):
+        self.manifest = manifest
+        self.mode = mode
+        self.on_result = on_result
+        self.lock = threading.Lock()
+        self.resources = {}  # канонический URL -> _Resource
+        self.repeats = 0
+
+    def add(self, ref):
+        """
+        Регистрирует ссылку. Возвращает True, если ресурс встретился
+        впервые и его нужно скачать.
+        """
+        with self.lock:
+            resource = self.resources.get(ref.url)
+            _metrics.cache("resources", resource is not None)
+            if resource is None:
+                resource = self.resources[ref.url] = _Resource()
+                resource.refs.append(ref)
+                return True
+            self.repeats += 1
+            if resource.result is None:
+                resource.refs.append(ref)
+                return False
+        self._deliver(ref, resource)
+        return False
+
+    def seed(self, url, path, info=None):
+        """
+        Отмечает ресурс, скачанный в прошлом запуске, как готовый.
+        """
+        with self.lock:
+            if url not in self.resources:
+                resource = self.resources[url] = _Resource()
+                # Без пути ресурс был проигнорирован
+                success = True if path else None
+                resource.result = (success, path, info or {})
+
+    def alias(self, url, target):
+        """
+        Связывает ссылку с ее конечным адресом (после раскрытия короткой
+        ссылки). Возвращает False, если ресурс по конечному адресу уже
+        скачивается или скачан, - тогда скачивать его заново не нужно.
+        """
+        with self.lock:
+            resource = self.resources[url]
+            other = self.resources.get(target)
+            if other is None or other is resource:
+                self.resources[target] = resource
+                return True
+            self.resources[url] = other
+            refs, resource.refs = resource.refs, []
+            if other.result is None:
+                other.refs.extend(refs)
+                return False
+        for ref in refs:
+            self._deliver(ref, other)
+        return False
+
+    def complete(self, url, success, path=None, info=None):
+        """
+        Сохраняет результат скачивания ресурса и раздает его всем
+        сообщениям, которые на него ссылаются.
+        """
+        with self.lock:
+            resource = self.resources[url]
+            resource.result = (success, path, info or {})
+            refs, resource.refs = resource.refs, []
+        if success and self.manifest:
+            self.manifest.remember(url, path, info)
+        for ref in refs:
+            self._deliver(ref, resource)
+
+    def _deliver(self, ref, resource):
+        success, path, info = resource.result
+        if success:
+            try:
+                path = self._place(resource, ref.dest_dir)
+            except OSError as e:
+                print(f"Не удалось связать {path} с {ref.dest_dir}: {e}")
+                success, path = False, None
+        if self.manifest:
+            status = {True: "done", False: "error", None: "ignored"}[success]
+            self.manifest.record(ref.url, ref.message_id, ref.month, status, path, info)
+        if self.on_result:
+            self.on_result(ref, success, path, info)
+
+    def _place(self, resource, dest_dir):
+        # Возвращает путь к файлу ресурса в папке dest_dir; в каждую
+        # папку ресурс попадает один раз
+        path = resource.result[1]
+        with resource.lock:
+            if not resource.placed:
+                resource.placed[os.path.dirname(path)] = path
+            placed = resource.placed.get(dest_dir)
+            if placed:
+                return placed
+            dest_path = reserve_unique_filename(
+                os.path.join(dest_dir, os.path.basename(path))
+            )
+            try:
+                if os.path.isdir(path):
+                    shutil.copytree(path, dest_path, copy_function=self._link_or_copy)
+                else:
+                    self._link_or_copy(path, dest_path)
+            finally:
+                release_filename(dest_path)
+            resource.placed[dest_dir] = dest_path
+            return dest_path
+
+    def _link_or_copy(self, source_path, dest_path):
+        if self.mode != "copy":
+            try:
+                link_file(source_path, dest_path, self.mode)
+                return dest_path
+            except OSError:
+                pass
+        shutil.copy2(source_path, dest_path)
+        return dest_path
+
+    def print_summary(self):
+        if self.repeats:
+            print(f"Повторных ссылок: {self.repeats} (каждый ресурс скачан один раз)")
+
+
+class LinkIndex:
+    """
+    Индекс ссылок запуска в формате JSON Lines. Строка пишется сразу,
+    как только становится известен статус ссылки, поэтому при сбое
+    индекс сохраняет все обработанные до него ссылки.
+
+    Поля строки: message_id, date, url (канонический), host, kind
+    (LINK_*), status, path, size, elapsed (секунды скачивания).
+    Статусы: found - ссылка найдена (и ждет скачивания, если оно
+    включено), skipped - пропущена по типу, cached - скачана в прошлых
+    запусках, done / error / ignored - результат скачивания. У ссылки,
+    которая скачивалась, две строки: found и результат.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.seconds = 0.0  # время записи (шаг "links" в метриках)
+        # Построчная буферизация: каждая строка сразу попадает в файл
+        mode = "a" if append else "w"
+        self.file = open(path, mode, encoding="utf-8", buffering=1)
+
+    def add(
+        self, message_id, date, url, kind, status, path=None, size=None, elapsed=None
+    ):
+        started = time.perf_counter()
+        line = json.dumps(
+            {
+                "message_id": message_id,
+                "date": date,
+                "url": url,
+                "host": urlparse(url).hostname,
+                "kind": kind,
+                "status": status,
+                "path": path,
+                "size": size,
+                "elapsed": round(elapsed, 3) if elapsed is not None else None,
+            },
+            ensure_ascii=False,
+        )
+        with self.lock:
+            self.file.write(line + "\n")
+            self.seconds += time.perf_counter() - started
+
+    def close(self):
+        self.file.close()
+
+
+def iter_link_index(path):
+    """
+    Перебирает строки индекса ссылок (links.jsonl) в виде словарей.
+    Оборванная последняя строка (сбой во время записи) пропускается.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def _index_link(row):
+    # Строка текстового списка "YYYY-MM: url" из строки индекса
+    month = row["date"][:7] if row.get("date") else None
+    return format_link(month, row["url"])
+
+
+def write_link_views(index_path, target_dir, links=True, problems=True):
+    """
+    Строит текстовые списки из индекса ссылок: links.txt (все ссылки без
+    повторов, в порядке экспорта), skipped.txt (пропущенные по типу, без
+    повторов) и errors.txt (ошибки скачивания). Возвращает число строк
+    в links.txt.
+
+    links - создавать links.txt, problems - skipped.txt и errors.txt.
+    links.txt пишется через временный файл и заменяется, только если
+    ссылки найдены: прежний список не пропадает.
+    """
+    links_file_path = os.path.join(target_dir, "links.txt")
+    temp_path = links_file_path + ".tmp"
+    seen_links = set()
+    seen_skipped = set()
+    skipped_links = []
+    error_links = {}  # URL -> {строка списка: id сообщения}
+    errors_resolved = False  # были ошибки, скачанные в следующих запусках
+    links_count = 0
+
+    links_file = open(temp_path, "w", encoding="utf-8") if links else None
+    try:
+        for row in iter_link_index(index_path):
+            url = row["url"]
+            if links_file and url not in seen_links:
+                seen_links.add(url)
+                links_file.write(_index_link(row) + "\n")
+                links_count += 1
+            if not problems:
+                continue
+            if row["status"] == "skipped" and url not in seen_skipped:
+                seen_skipped.add(url)
+                skipped_links.append(_index_link(row))
+            elif row["status"] == "error":
+                link = _index_link(row)
+                error_links.setdefault(url, {}).setdefault(link, row["message_id"] or 0)
+            elif row["status"] in ("done", "cached"):
+                # Ссылка скачана в одном из следующих запусков
+                if error_links.pop(url, None):
+                    errors_resolved = True
+    finally:
+        if links_file:
+            links_file.close()
+
+    if links:
+        if links_count:
+            os.replace(temp_path, links_file_path)
+            print(f"Сохранено {links_count} ссылок в файл: {links_file_path}")
+        else:
+            os.remove(temp_path)
+            print("Ссылки в сообщениях не найдены.")
+
+    if not problems:
+        return links_count
+
+    if skipped_links:
+        skipped_file_path = os.path.join(target_dir, "skipped.txt")
+        with open(skipped_file_path, "w", encoding="utf-8") as f:
+            for link in skipped_links:
+                f.write(link + "\n")
+        print(
+            f"Сохранено {len(skipped_links)} пропущенных ссылок в файл: {skipped_file_path}"
+        )
+
+    # errors.txt прошлого запуска переписывается, если его ссылки уже скачаны
+    if error_links or errors_resolved:
+        # Результаты пишутся по мере скачивания: восстанавливаем порядок экспорта
+        error_links = sorted(
+            (message_id, link)
+            for links_by_month in error_links.values()
+            for link, message_id in links_by_month.items()
+        )
+        error_links = [link for _, link in error_links]
+        error_file_path = os.path.join(target_dir, "errors.txt")
+        with open(error_file_path, "w", encoding="utf-8") as f:
+            for link in error_links:
+                f.write(link + "\n")
+        print(
+            f"Сохранено {len(error_links)} ссылок с ошибками в файл: {error_file_path}"
+        )
+
+    if not skipped_links and not error_links:
+        print("Все ссылки успешно обработаны - нет пропущенных или ошибок!")
+    return links_count
+
+
+def should_ignore_file(filename):
+    """
+    Проверяет, нужно ли игнорировать файл.
+    """
+    return filename in IGNORED_FILES
+
+
+# Размер блока, которым читается JSON-файл экспорта при потоковом разборе
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+class _JsonStream:
+    """
+    Буфер для потокового чтения JSON: держит в памяти только
+    еще не разобранный хвост файла.
+    """
+
+    def __init__(self, f, chunk_size=STREAM_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+
+    def fill(self, min_size=0):
+        """
+        Дочитывает следующий блок файла. Размер блока растет вместе с
+        неразобранным хвостом, чтобы большие значения не разбирались заново
+        после каждого маленького блока.
+        """
+        if self.eof:
+            return False
+        raw = self.f.read(max(self.chunk_size, min_size))
+        self.bytes_read += len(raw)
+        if not raw:
+            self.eof = True
+            self.buf = self.buf[self.pos :] + self.decoder.decode(b"", final=True)
+        else:
+            self.buf = self.buf[self.pos :] + self.decoder.decode(raw)
+        self.pos = 0
+        return True
+
+    def skip_ws(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf) or not self.fill():
+                return
+
+    def peek(self):
+        self.skip_ws()
+        if self.pos >= len(self.buf):
+            raise json.JSONDecodeError("Неожиданный конец файла", self.buf, self.pos)
+        return self.buf[self.pos]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Ожидался символ {char!r}", self.buf, self.pos)
+        self.pos += 1
+
+    def value(self):
+        """
+        Разбирает очередное JSON-значение, при необходимости дочитывая файл.
+        """
+        self.skip_ws()
+        while True:
+            try:
+                obj, end = self.json_decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill(len(self.buf) - self.pos):
+                    raise
+                continue
+            # Число на границе блока могло быть прочитано не полностью
+            if end == len(self.buf) and self.fill(len(self.buf) - self.pos):
+                continue
+            self.pos = end
+            return obj
+
+
+def iter_export_messages(json_file_path, on_progress=None):
+    """
+    Потоково перебирает сообщения из массива "messages" экспорта Telegram,
+    не загружая весь файл в память.
+
+    Args:
+        json_file_path: путь к JSON файлу с экспортом
+        on_progress: необязательная функция, которой передается
+            количество прочитанных байт файла
+    """
+    with open(json_file_path, "rb") as f:
+        stream = _JsonStream(f)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+
+        while True:
+            key = stream.value()
+            stream.expect(":")
+            if key == "messages" and stream.peek() == "[":
+                stream.pos += 1
+                if stream.peek() != "]":
+                    while True:
+                        message = stream.value()
+                        if on_progress:
+                            on_progress(stream.bytes_read)
+                        yield message
+                        if stream.peek() == "]":
+                            break
+                        stream.expect(",")
+                stream.pos += 1
+            else:
+                # Остальные поля верхнего уровня (name, type, id) пропускаем
+                stream.value()
+
+            if stream.peek() == "}":
+                break
+            stream.expect(",")
+
+    if on_progress:
+        on_progress(stream.bytes_read)
+
+
+def read_export_header(json_file_path):
+    """
+    Читает поля верхнего уровня экспорта, идущие до массива "messages"
+    (name, type, id), не разбирая сами сообщения.
+    """
+    header = {}
+    with open(json_file_path, "rb") as f:
+        stream = _JsonStream(f)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return header
+        while True:
+            key = stream.value()
+            stream.expect(":")
+            if key == "messages":
+                break
+            header[key] = stream.value()
+            if stream.peek() == "}":
+                break
+            stream.expect(",")
+    return header
+
+
+def export_chat_key(header, json_file_path):
+    """
+    Ключ чата для отметки инкрементальной обработки: id чата из экспорта,
+    иначе его название, иначе путь к папке экспорта.
+    """
+    if header.get("id") is not None:
+        return str(header["id"])
+    return header.get("name") or os.path.dirname(os.path.abspath(json_file_path))
+
+
+def iter_messages_with_progress(json_file_path, desc):
+    """
+    Потоково перебирает сообщения экспорта, показывая прогресс
+    по смещению в файле, а не по количеству сообщений.
+    """
+    total_size = os.path.getsize(json_file_path)
+    with tqdm(total=total_size, unit="B", unit_scale=True, desc=desc) as pbar:
+
+        def update(offset):
+            pbar.update(offset - pbar.n)
+
+        yield from iter_export_messages(json_file_path, on_progress=update)
+
+
+# Компактная запись о сообщении: id, дата, папка месяца (YYYY-MM или None),
+# путь к вложению и список ссылок вида (url, тип ссылки)
+MessageRecord = namedtuple("MessageRecord", "id date month attachment urls")
+
+
+def parse_message(message):
+    """
+    Разбирает сообщение экспорта в MessageRecord. Дата, вложение и ссылки
+    извлекаются один раз, дальше шаги обработки работают с записью.
+    """
+    # Проверяем, есть ли в сообщении прикрепленный файл
+    attachment = None
+    for key in ATTACHMENT_KEYS:
+        value = message.get(key)
+        if isinstance(value, str):
+            attachment = value
+            break
+
+    # Форматируем дату в YYYY-MM
+    month = None
+    date_str = message.get("date")
+    if date_str:
+        month = datetime.fromisoformat(date_str).strftime("%Y-%m")
+
+    urls = []
+    for entity in message.get("text_entities", []):
+        url = None
+        if entity.get("type") == "link":
+            url = entity.get("text")
+        elif entity.get("type") == "text_link":
+            url = entity.get("href")
+
+        if url and url.startswith(("http://", "https://")):
+            urls.append((url, classify_link(url)))
+
+    return MessageRecord(message.get("id"), date_str, month, attachment, urls)
+
+
+def classify_link(url):
+    """
+    Определяет тип ссылки: LINK_SKIP, LINK_YANDEX, LINK_HTML или LINK_FILE.
+    """
+    return _url_classifier.classify(url)
+
+
+def format_link(month, url):
+    """
+    Строка для links.txt, skipped.txt и errors.txt: "YYYY-MM: url".
+    """
+    return f"{month}: {url}" if month else url
+
+
+def iter_links_from_messages(messages):
+    """
+    Перебирает ссылки из сообщений в формате "YYYY-MM: url".
+    """
+    for message in messages:
+        record = parse_message(message)
+        for url, _ in record.urls:
+            yield format_link(record.month, url)
+
+
+def collect_links_from_messages(messages):
+    """
+    Собирает все ссылки из сообщений и возвращает их список.
+    Принимает список или итератор сообщений.
+    """
+    return list(iter_links_from_messages(messages))
+
+
+# Общая HTTP-сессия: соединения переиспользуются между запросами и потоками
+_http_session = None
+_http_session_lock = threading.Lock()
+_http_config = {
+    "user_agent": DEFAULT_USER_AGENT,
+    "pool_connections": DEFAULT_POOL_CONNECTIONS,
+    "pool_maxsize": DEFAULT_POOL_MAXSIZE,
+    "title_bytes": TITLE_SCAN_BYTES,
+    "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+    "read_timeout": DEFAULT_READ_TIMEOUT,
+    "retries": DEFAULT_RETRIES,
+    "segments": DEFAULT_SEGMENTS,
+}
+
+
+def _supported_encodings():
+    """
+    Возвращает значение Accept-Encoding: brotli объявляем, только если
+    установлен модуль, которым urllib3 сможет его распаковать.
+    """
+    encodings = ["gzip", "deflate"]
+    for module in ("brotli", "brotlicffi"):
+        try:
+            __import__(module)
+        except ImportError:
+            continue
+        encodings.append("br")
+        break
+    return ", ".join(encodings)
+
+
+def configure_http(
+    user_agent=None,
+    pool_connections=None,
+    pool_maxsize=None,
+    title_bytes=None,
+    connect_timeout=None,
+    read_timeout=None,
+    retries=None,
+    segments=None,
+):
+    """
+    Меняет настройки общей HTTP-сессии. Сессия будет пересоздана
+    при следующем запросе.
+
+    title_bytes - сколько первых байт страницы просматривать в поисках <title>.
+    connect_timeout, read_timeout - таймауты соединения и чтения (секунды).
+    retries - сколько раз повторять запрос при временной ошибке.
+    segments - на сколько частей делить большие файлы (1 - не делить).
+    """
+    global _http_session
+    with _http_session_lock:
+        if user_agent:
+            _http_config["user_agent"] = user_agent
+        if connect_timeout:
+            _http_config["connect_timeout"] = connect_timeout
+        if read_timeout:
+            _http_config["read_timeout"] = read_timeout
+        if retries is not None:
+            _http_config["retries"] = max(0, retries)
+        if segments is not None:
+            _http_config["segments"] = max(1, segments)
+        if title_bytes:
+            _http_config["title_bytes"] = title_bytes
+        if pool_connections:
+            _http_config["pool_connections"] = pool_connections
+        if pool_maxsize:
+            _http_config["pool_maxsize"] = pool_maxsize
+        if _http_session is not None:
+            _http_session.close()
+            _http_session = None
+
+
+def get_http_session():
+    """
+    Возвращает общую HTTP-сессию с keep-alive и пулом соединений на хост.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=_http_config["pool_connections"],
+                pool_maxsize=_http_config["pool_maxsize"],
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(
+                {
+                    "User-Agent": _http_config["user_agent"],
+                    "Accept-Encoding": _supported_encodings(),
+                }
+            )
+            _http_session = session
+        return _http_session
+
+
+def http_timeout():
+    """
+    Таймаут запроса в формате requests: (соединение, чтение).
+    """
+    return (_http_config["connect_timeout"], _http_config["read_timeout"])
+
+
+def http_request(method, url, **kwargs):
+    """
+    Запрос через общую HTTP-сессию с учетом ограничений хоста
+    (HostThrottle). Все сетевые запросы модуля должны идти через эту
+    функцию или ее обертки http_get и http_head.
+    """
+    kwargs.setdefault("timeout", http_timeout())
+    host = urlparse(url).netloc.lower()
+    _host_throttle.acquire(host)
+    started = time.monotonic()
+    try:
+        response = get_http_session().request(method, url, **kwargs)
+    except Exception:
+        _metrics.request(host, time.monotonic() - started, error=True)
+        raise
+    _metrics.request(host, time.monotonic() - started, response.status_code >= 400)
+    _host_throttle.feedback(host, response.status_code, get_retry_after(response))
+    return response
+
+
+def http_get(url, **kwargs):
+    """
+    GET-запрос через общую HTTP-сессию.
+    """
+    return http_request("GET", url, **kwargs)
+
+
+def http_head(url, **kwargs):
+    """
+    HEAD-запрос через общую HTTP-сессию.
+    """
+    return http_request("HEAD", url, **kwargs)
+
+
+class IncompleteDownload(IOError):
+    """
+    Соединение закрылось раньше, чем пришли все байты ответа.
+    """
+
+
+def get_retry_after(response):
+    """
+    Задержка из заголовка Retry-After (секунды или HTTP-дата) или None.
+    """
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (
+                parsedate_to_datetime(value) - datetime.now(timezone.utc)
+            ).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(0.0, delay), RETRY_AFTER_MAX)
+
+
+def retry_delay(error, attempt):
+    """
+    Сколько ждать перед повтором после ошибки error (attempt - номер
+    неудачной попытки с нуля) или None, если ошибка не временная.
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        if response.status_code not in RETRY_STATUSES:
+            return None
+        retry_after = get_retry_after(response)
+        if retry_after is not None:
+            return retry_after
+    elif not isinstance(error, (requests.RequestException, IncompleteDownload)):
+        return None
+    # Экспоненциальная задержка с полным случайным разбросом
+    ceiling = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2**attempt)
+    return random.uniform(ceiling / 2, ceiling)
+
+
+# Была ли последняя ошибка, на которой call_with_retries сдался в этом
+# потоке, временной (повторы кончились) или постоянной (например, 404)
+_last_failure = threading.local()
+
+
+def last_failure_transient():
+    """
+    Проверяет, была ли последняя неудачная попытка запроса в этом потоке
+    временной ошибкой. Перед скачиванием сбрасывается reset_last_failure.
+    """
+    return getattr(_last_failure, "transient", False)
+
+
+def reset_last_failure():
+    _last_failure.transient = False
+
+
+def call_with_retries(func, url):
+    """
+    Вызывает func() и повторяет при временных ошибках (сеть, таймаут,
+    429, 5xx, оборванный ответ). Последняя ошибка выбрасывается.
+    """
+    retries = _http_config["retries"]
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None or attempt >= retries:
+                _last_failure.transient = delay is not None
+                raise
+            attempt += 1
+            _metrics.retry(urlparse(url).netloc.lower())
+            print(f"Повтор {attempt}/{retries} для {url} через {delay:.1f} с: {e}")
+            time.sleep(delay)
+
+
+def reset_run_caches():
+    """
+    Сбрасывает кэши, которые живут в пределах одного запуска: метаданные
+    Яндекс.Диска, title страниц, короткие ссылки и индекс имен файлов.
+    Нужно, когда в одном процессе идет несколько запусков (--watch,
+    пакетная обработка): иначе кэши растут без ограничения и устаревают.
+    """
+    global _filename_index
+    with _yandex_lock:
+        _yandex_meta_cache.clear()
+    with _short_url_lock:
+        _short_url_cache.clear()
+    _filename_index = FilenameIndex()
+
+
+def find_and_process_files(
+    json_file_path,
+    target_dir,
+    download_files=False,
+    collect_links=True,
+    jobs=DEFAULT_JOBS,
+    per_host_jobs=DEFAULT_PER_HOST_JOBS,
+    use_manifest=True,
+    dedup=None,
+    attachments_mode="copy",
+    copy_jobs=DEFAULT_COPY_JOBS,
+    prometheus_file=None,
+    max_age=None,
+    cache_size=None,
+    text_views=True,
+    incremental=False,
+):
+    """
+    Главная функция для обработки JSON-экспорта Telegram.
+    Возвращает сводку метрик запуска (Metrics.summary) или None, если
+    экспорт не удалось прочитать.
+
+    Args:
+        json_file_path: путь к JSON файлу с экспортом
+        target_dir: целевая директория для сохранения
+        download_files: флаг - скачивать ли файлы по ссылкам
+        collect_links: флаг - собирать ли ссылки в файл
+        jobs: общее число одновременных скачиваний
+        per_host_jobs: максимум одновременных скачиваний с одного хоста
+        use_manifest: пропускать ссылки, уже скачанные в прошлых запусках
+            (по манифесту в target_dir)
+        dedup: режим дедупликации одинаковых файлов ("hardlink", "reflink")
+            или None
+        attachments_mode: как переносить вложения в target_dir
+            ("copy", "hardlink", "reflink", "symlink")
+        copy_jobs: число потоков копирования вложений
+        prometheus_file: куда дополнительно записать метрики в формате
+            Prometheus textfile (JSON-сводка всегда пишется в metrics.json)
+        max_age: через сколько секунд после скачивания или прошлой проверки
+            ссылку нужно перепроверить условным запросом (None - не
+            перепроверять, 0 - перепроверять всегда)
+        cache_size: сколько записей кэша ревалидации хранить (LRU)
+        text_views: строить links.txt, skipped.txt и errors.txt из индекса
+            ссылок (links.jsonl пишется всегда)
+        incremental: пропускать сообщения чата, обработанные в прошлых
+            запусках (до отметки в манифесте), и сдвигать отметку
+    """
+    global _metrics
+
+    reset_run_caches()
+
+    # Определяем директорию, где находится JSON-файл.
+    # Это нужно, чтобы правильно находить локальные файлы из экспорта (photos/, files/ и т.д.)
+    export_base_dir = os.path.dirname(os.path.abspath(json_file_path))
+
+    # Проверяем JSON-файл: сообщения читаются потоково, поэтому здесь
+    # достаточно убедиться, что он открывается и начинается корректно
+    try:
+        first_message = next(iter_export_messages(json_file_path), None)
+    except FileNotFoundError:
+        print(f"Ошибка: JSON-файл '{json_file_path}' не найден.")
+        return
+    except json.JSONDecodeError:
+        print(
+            f"Ошибка: Не удалось прочитать JSON-файл '{json_file_path}'. Проверьте его формат."
+        )
+        return
+
+    # Создаем основную папку для загрузок, если ее нет
+    os.makedirs(target_dir, exist_ok=True)
+    print(f"Файлы будут сохранены в папку: '{os.path.abspath(target_dir)}'")
+
+    if first_message is None:
+        print("В JSON-файле не найдено сообщений.")
+        return
+
+    _metrics = Metrics()
+    started = time.monotonic()
+
+    manifest = None
+    if use_manifest and (download_files or dedup or incremental):
+        manifest = Manifest(os.path.join(target_dir, MANIFEST_FILENAME))
+
+    # Инкрементальный режим: сообщения до отметки чата уже обработаны.
+    # Telegram нумерует сообщения чата по возрастанию, поэтому старые
+    # сообщения отсекаются по id до разбора записи
+    watermark = None
+    if incremental and not manifest:
+        print("Инкрементальный режим требует манифеста и отключен (--no-manifest)")
+        incremental = False
+    if incremental:
+        header = read_export_header(json_file_path)
+        chat = export_chat_key(header, json_file_path)
+        # У запусков без скачивания своя отметка: они не должны сдвигать
+        # отметку, после которой ссылки скачиваются
+        if not download_files:
+            chat += WATERMARK_LINKS_SUFFIX if collect_links else WATERMARK_COPY_SUFFIX
+        watermark = manifest.watermark(chat)
+        if watermark is not None:
+            print(
+                f"Инкрементальный режим: обрабатываются сообщения после id {watermark}"
+            )
+    last_message = None  # (id, дата) последнего обработанного сообщения
+    # id первого сообщения со ссылкой, не скачанной из-за временной ошибки
+    first_error_id = None
+    messages_before_watermark = 0
+
+    # Без манифеста индекс хэшей живет только до конца запуска
+    deduplicator = None
+    if dedup:
+        deduplicator = Deduplicator(manifest or Manifest(":memory:"), dedup)
+
+    # Экспорт читается один раз: каждое сообщение разбирается в компактную
+    # запись и сразу передается всем шагам. Скачивания начинаются, не
+    # дожидаясь конца файла
+    print("\n--- Обработка экспорта ---")
+    print("Шаг 1: копирование прикрепленных файлов")
+    materializer = AttachmentMaterializer(attachments_mode, copy_jobs, deduplicator)
+
+    # Ссылки пишутся в индекс сразу по мере чтения и скачивания, не
+    # накапливаясь в памяти; текстовые списки строятся из него в конце
+    index = None
+    if collect_links or download_files:
+        if collect_links:
+            print("Шаг 2: сбор ссылок из сообщений")
+        # В инкрементальном режиме индекс дополняется: текстовые списки
+        # строятся из всех запусков
+        index = LinkIndex(
+            os.path.join(target_dir, LINK_INDEX_FILENAME), append=incremental
+        )
+
+    # Ссылки сравниваются в каноническом виде: повторы одного ресурса
+    # считаются один раз
+    seen_links = set()
+    seen_skipped = set()
+
+    scheduler = None
+    registry = None
+    results_lock = threading.Lock()
+
+    def on_result(ref, success, path, info):
+        nonlocal first_error_id
+        status = {True: "done", False: "error", None: "ignored"}[success]
+        # Отметку держит только временная ошибка: постоянная (например,
+        # 404) не исправится и в следующий раз
+        transient = success is False and info.get("transient")
+        if transient and isinstance(ref.message_id, int):
+            with results_lock:
+                if first_error_id is None or ref.message_id < first_error_id:
+                    first_error_id = ref.message_id
+        _metrics.count(
+            {
+                True: "downloads_done",
+                False: "downloads_failed",
+                None: "downloads_ignored",
+            }[success]
+        )
+        index.add(
+            ref.message_id,
+            ref.date,
+            ref.url,
+            ref.kind,
+            status,
+            path,
+            info.get("size"),
+            info.get("elapsed"),
+        )
+
+    if download_files:
+        print("Шаг 3: скачивание файлов по ссылкам")
+        print(f"Потоков скачивания: {jobs}, на один хост: {per_host_jobs}")
+        scheduler = DownloadScheduler(jobs, per_host_jobs)
+        # Повторы ресурса в других месяцах связываются с уже скачанным файлом
+        registry = LinkRegistry(manifest, dedup or attachments_mode, on_result)
+    already_done = 0
+    revalidated = [0, 0]  # не изменились, изменились
+    messages_count = 0
+
+    # Ошибка формата в середине файла не прерывает запуск: уже прочитанные
+    # сообщения обрабатываются до конца, результаты сохраняются
+    export_error = None
+
+    def iter_messages():
+        nonlocal export_error
+        try:
+            yield from iter_messages_with_progress(
+                json_file_path, "Обработка сообщений"
+            )
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            export_error = e
+
+    # Шаги 1-3 идут параллельно: у каждого свое время работы, а не время
+    # от начала запуска
+    loop_started = time.monotonic()
+    links_seconds = 0.0
+    for message in iter_messages():
+        message_id = message.get("id")
+        if isinstance(message_id, int):
+            if watermark is not None and message_id <= watermark:
+                messages_before_watermark += 1
+                continue
+            if last_message is None or message_id > last_message[0]:
+                last_message = (message_id, message.get("date"))
+        record = parse_message(message)
+        messages_count += 1
+
+        # --- 1. Обработка прикрепленных файлов ---
+        if record.attachment and record.month:
+            # Копируем файл с сохранением оригинального имени
+            materializer.submit(
+                os.path.join(export_base_dir, record.attachment),
+                os.path.join(target_dir, record.month),
+                os.path.basename(record.attachment),
+            )
+
+        if not index:
+            continue
+        links_started = time.perf_counter()
+        urls = [(canonicalize_url(url), kind) for url, kind in record.urls]
+        links_seconds += time.perf_counter() - links_started
+
+        # --- 2. Сбор ссылок и 3. скачивание файлов по ссылкам ---
+        for url, kind in urls:
+            if collect_links:
+                seen_links.add(url)
+            if not scheduler:
+                index.add(record.id, record.date, url, kind, "found")
+                continue
+
+            # Пропускаем ссылки на соцсети и видеохостинги, которые не являются прямыми файлами
+            if kind == LINK_SKIP:
+                seen_skipped.add(url)
+                index.add(record.id, record.date, url, kind, "skipped")
+                continue
+
+            if not record.month:
+                index.add(record.id, record.date, url, kind, "found")
+                continue
+
+            # Уже скачано в одном из прошлых запусков: запоминаем файл,
+            # чтобы повторы в новых сообщениях связывались с ним.
+            # Если запись старше max_age, ссылка перепроверяется
+            stale = None
+            if manifest:
+                entry = None
+                if manifest.is_done(url, record.id):
+                    entry = manifest.get(url, record.id)
+                cached = manifest.cached(url)
+                if (
+                    cached
+                    and max_age is not None
+                    and (time.time() - cached["checked_at"] > max_age)
+                ):
+                    stale = cached
+                elif cached:
+                    registry.seed(url, cached["path"], cached)
+                elif entry:
+                    # Ссылка была проигнорирована или вытеснена из кэша
+                    # ревалидации (--cache-size) и больше не перепроверяется
+                    registry.seed(url, entry["path"], entry)
+                if entry and not stale:
+                    already_done += 1
+                    index.add(
+                        record.id,
+                        record.date,
+                        url,
+                        kind,
+                        "cached" if entry["status"] == "done" else "ignored",
+                        entry["path"],
+                        entry["size"],
+                    )
+                    continue
+
+            # Создаем папку для сохранения
+            dest_dir = os.path.join(target_dir, record.month)
+            materializer.dirs.ensure_dir(dest_dir)
+
+            ref = LinkRef(url, record.id, record.date, record.month, kind, dest_dir)
+            # Строка found пишется до регистрации: повтор уже скачанного
+            # ресурса получает результат сразу в registry.add
+            index.add(record.id, record.date, url, kind, "found")
+            if not registry.add(ref):
+                continue
+
+            # Имя файла определяется уже в рабочем потоке: для HTML и
+            # Яндекс.Диска для этого нужны сетевые запросы
+            def task(ref=ref, stale=stale):
+                # Не изменившийся ресурс не скачивается заново
+                if stale:
+                    check_started = time.monotonic()
+                    unchanged = revalidate_link(ref.url, stale)
+                    _metrics.cache("revalidate", unchanged)
+                    with results_lock:
+                        revalidated[0 if unchanged else 1] += 1
+                    if unchanged:
+                        info = {**stale, "elapsed": time.monotonic() - check_started}
+                        registry.complete(ref.url, True, stale["path"], info)
+                        return
+                source = ref.url
+                # Короткая ссылка может вести на уже скачиваемый ресурс
+                if is_short_url(source):
+                    source = resolve_short_url(source)
+                    if not registry.alias(ref.url, source):
+                        return
+                fetch_started = time.monotonic()
+                reset_last_failure()
+                try:
+                    # Изменившийся ресурс обновляется на месте прежней копии
+                    replace_path = None
+                    if stale and stale["path"] and os.path.exists(stale["path"]):
+                        replace_path = stale["path"]
+                        if deduplicator:
+                            deduplicator.index.forget_blob(replace_path)
+                    success, final_path, info = fetch_link(
+                        source,
+                        ref.message_id,
+                        ref.dest_dir,
+                        deduplicator,
+                        replace_path,
+                    )
+                except Exception as e:
+                    print(f"✗ Ошибка скачивания {source}: {e}")
+                    success, final_path, info = False, None, {}
+                info = {**info, "elapsed": time.monotonic() - fetch_started}
+                if success is False:
+                    info["transient"] = last_failure_transient()
+                registry.complete(ref.url, success, final_path, info)
+
+            scheduler.submit(urlparse(url).netloc.lower(), task)
+    if export_error:
+        print(
+            f"Ошибка: Не удалось прочитать JSON-файл '{json_file_path}'. "
+            "Проверьте его формат."
+        )
+        print(f"Обработаны сообщения до места ошибки ({export_error})")
+        _metrics.count("export_errors")
+    _metrics.add_phase("export", time.monotonic() - loop_started)
+    _metrics.count("messages", messages_count)
+    _metrics.count("links", len(seen_links))
+
+    materializer.join()
+    _metrics.count("attachments", materializer.done)
+    materializer.print_summary()
+
+    if scheduler:
+        scheduler.join()
+        _metrics.count("already_done", already_done)
+        _metrics.count("skipped", len(seen_skipped))
+        if already_done:
+            print(f"Пропущено ранее скачанных ссылок: {already_done}")
+        if any(revalidated):
+            print(
+                f"Перепроверено ссылок: {sum(revalidated)}, не изменились: "
+                f"{revalidated[0]}, скачаны заново: {revalidated[1]}"
+            )
+        registry.print_summary()
+        if _host_throttle.throttled:
+            print(
+                f"Хосты просили снизить нагрузку (429/503): "
+                f"{_host_throttle.throttled} раз"
+            )
+
+    if deduplicator:
+        deduplicator.print_summary()
+        if deduplicator.index is not manifest:
+            deduplicator.index.close()
+    if incremental and last_message:
+        # Отметка не заходит за первое сообщение с ошибкой скачивания,
+        # чтобы в следующий раз его ссылки скачивались снова
+        message_id, date = last_message
+        if first_error_id is not None and first_error_id <= message_id:
+            message_id, date = first_error_id - 1, None
+        if watermark is None or message_id > watermark:
+            manifest.set_watermark(chat, header.get("name"), message_id, date)
+            print(f"Отметка чата сдвинута до сообщения id {message_id}")
+    if messages_before_watermark:
+        _metrics.count("messages_before_watermark", messages_before_watermark)
+        print(f"Пропущено ранее обработанных сообщений: {messages_before_watermark}")
+    if manifest:
+        if cache_size is not None:
+            evicted = manifest.evict(cache_size)
+            if evicted:
+                print(f"Удалено старых записей кэша ревалидации: {evicted}")
+        manifest.close()
+
+    # --- 4. Текстовые списки ссылок, пропущенных и неудачных ---
+    if index:
+        index.close()
+        views_started = time.monotonic()
+        if text_views:
+            write_link_views(
+                index.path, target_dir, links=collect_links, problems=download_files
+            )
+        links_seconds += index.seconds + time.monotonic() - views_started
+        _metrics.add_phase("links", links_seconds)
+
+    # --- Метрики запуска ---
+    _metrics.add_phase("total", time.monotonic() - started)
+    _metrics.print_summary()
+    metrics_path = os.path.join(target_dir, METRICS_FILENAME)
+    _metrics.write_json(metrics_path)
+    print(f"Метрики сохранены в файл: {metrics_path}")
+    if prometheus_file:
+        _metrics.write_prometheus(prometheus_file)
+        print(f"Метрики Prometheus сохранены в файл: {prometheus_file}")
+
+    print("\nГотово! Все найденные файлы обработаны.")
+    if index:
+        print(f"Индекс ссылок сохранен в файл: {index.path}")
+
+    return _metrics.summary()
+
+
+def fetch_link(url, message_id, dest_dir, deduplicator=None, replace_path=None):
+    """
+    Скачивает одну ссылку в папку месяца без записи в манифест.
+    replace_path - уже скачанный файл этой ссылки: изменившийся ресурс
+    заменяет его на месте, а не сохраняется рядом под новым именем.
+
+    Возвращает (success, final_path, info), где success - True, False
+    или None (файл проигнорирован).
+    """
+    print(f"\nНайдена ссылка: {url}")
+
+    success, final_path, info = get_backend(url).fetch(
+        url, message_id, dest_dir, replace_path
+    )
+
+    if success and deduplicator and info.get("sha256"):
+        original = deduplicator.dedupe(final_path, info["sha256"], info["size"])
+        if original:
+            print(f"Дубликат {os.path.basename(original)}: связан вместо копии")
+
+    if success:
+        try:
+            file_size = info.get("size") or os.path.getsize(final_path)
+            file_size_mb = file_size / (1024 * 1024)
+            final_file_name = os.path.basename(final_path)
+            print(f"✓ Скачан: {final_file_name} ({file_size_mb:.2f} МБ)")
+        except:
+            final_file_name = os.path.basename(final_path)
+            print(f"✓ Скачан: {final_file_name}")
+    elif success is False:
+        print(f"✗ Ошибка скачивания: {url}")
+
+    return success, final_path, info
+
+
+def revalidate_link(url, cached):
+    """
+    Проверяет, не изменился ли ресурс с прошлого скачивания, не скачивая
+    тело: HEAD с If-None-Match / If-Modified-Since. Ресурс не изменился,
+    если сервер ответил 304, вернул те же валидаторы или (когда
+    валидаторов нет) тот же размер. Файлы Яндекс.Диска сверяются по
+    метаданным (SHA-256 или размер).
+
+    cached - запись Manifest.cached. Возвращает True, если ресурс не изменился.
+    """
+    try:
+        return get_backend(url).revalidate(url, cached)
+    except Exception as e:
+        print(f"Не удалось перепроверить {url}: {e}")
+        return False
+
+
+def _revalidate_http(url, cached):
+    # Условный HEAD-запрос; ошибки сети выбрасываются
+    headers = {}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    response = call_with_retries(
+        lambda: http_head(url, allow_redirects=True, headers=headers), url
+    )
+    response.close()
+
+    if response.status_code == 304:
+        return True
+    if response.status_code >= 400:
+        return False
+    etag = response.headers.get("etag")
+    if etag and cached.get("etag"):
+        return etag == cached["etag"] and not etag.startswith("W/")
+    last_modified = response.headers.get("last-modified")
+    if last_modified and cached.get("last_modified"):
+        return last_modified == cached["last_modified"]
+    size = int(response.headers.get("content-length") or 0)
+    encoded = response.headers.get("content-encoding", "identity") != "identity"
+    return bool(size) and not encoded and size == cached.get("size")
+
+
+def _revalidate_yandex(url, cached):
+    meta = get_yandex_public_meta(url)
+    # Состав папки не перепроверяется: достаточно, что она на месте
+    if getattr(meta, "type", None) == "dir":
+        return True
+    if cached.get("sha256") and getattr(meta, "sha256", None):
+        return meta.sha256 == cached["sha256"]
+    return getattr(meta, "size", None) == cached.get("size")
+
+
+class HostBackend:
+    """
+    Обработчик ссылок на хосты одного вида: скачивание, оценка размера
+    (--plan) и перепроверка (--max-age). Этот класс - общий HTTP backend;
+    наследники меняют способ доступа к файлу.
+
+    Модули из requires импортируются при первой ссылке на хост backend'а
+    (load), поэтому запуск без таких ссылок их не загружает.
+    """
+
+    name = "HTTP"
+    requires = ("requests",)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            with self.lock:
+                for module in self.requires:
+                    try:
+                        importlib.import_module(module)
+                    except ImportError as e:
+                        raise ImportError(
+                            f"Для ссылок {self.name} нужен модуль {module} "
+                            f"(pip install {module})"
+                        ) from e
+                self.loaded = True
+        return self
+
+    def direct_url(self, url):
+        """
+        Адрес, по которому отдается сам файл, а не страница с ним.
+        """
+        return url
+
+    def fetch(self, url, message_id, dest_dir, replace_path=None):
+        return download_http_link(
+            self.direct_url(url), message_id, dest_dir, replace_path
+        )
+
+    def estimate(self, url, message_id):
+        return _estimate_http(self.direct_url(url), message_id)
+
+    def revalidate(self, url, cached):
+        return _revalidate_http(self.direct_url(url), cached)
+
+
+class YandexDiskBackend(HostBackend):
+    """
+    Публичные файлы и папки Яндекс.Диска через API (yadisk).
+    """
+
+    name = "Яндекс.Диска"
+    rules_key = "yandex_domains"
+    requires = ("requests", "yadisk")
+
+    def fetch(self, url, message_id, dest_dir, replace_path=None):
+        return download_yandex_link(url, message_id, dest_dir, replace_path)
+
+    def estimate(self, url, message_id):
+        name, size = get_yandex_disk_file_info(url)
+        if is_yandex_folder(url):
+            size = sum(item.size or 0 for item in iter_yandex_public_folder(url))
+        if name is None:
+            name = get_fallback_filename(url, message_id)
+        return sanitize_filename(name), size, None
+
+    def revalidate(self, url, cached):
+        return _revalidate_yandex(url, cached)
+
+
+# Id файла Google Drive в ссылках вида /file/d/<id>/view и ?id=<id>
+_GDRIVE_ID_RE = re.compile(r"/file/d/([\w-]+)|[?&]id=([\w-]+)")
+
+
+class GoogleDriveBackend(HostBackend):
+    """
+    Файлы Google Drive: ссылка на страницу просмотра заменяется прямой
+    ссылкой на скачивание (без страницы предупреждения о проверке
+    на вирусы). Папки и другие страницы сохраняются как обычно.
+    """
+
+    name = "Google Drive"
+    rules_key = "gdrive_domains"
+
+    def direct_url(self, url):
+        match = _GDRIVE_ID_RE.search(urlsplit(url)._replace(fragment="").geturl())
+        if not match:
+            return url
+        file_id = match.group(1) or match.group(2)
+        return (
+            "https://drive.usercontent.google.com/download"
+            f"?id={file_id}&export=download&confirm=t"
+        )
+
+
+class DropboxBackend(HostBackend):
+    """
+    Файлы и папки Dropbox: параметр dl=1 отдает сам файл (папку - zip-архивом)
+    вместо страницы предпросмотра.
+    """
+
+    name = "Dropbox"
+    rules_key = "dropbox_domains"
+
+    def direct_url(self, url):
+        parts = urlsplit(url)
+        query = [
+            (key, value)
+            for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if key not in ("dl", "raw")
+        ]
+        query.append(("dl", "1"))
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class BackendRegistry:
+    """
+    Реестр backend'ов по хосту. Хост ссылки сравнивается с доменами из
+    правил (yandex_domains, gdrive_domains, dropbox_domains) по суффиксу,
+    как в UrlClassifier; остальные хосты обрабатывает общий HTTP backend.
+    """
+
+    backend_classes = (YandexDiskBackend, GoogleDriveBackend, DropboxBackend)
+
+    def __init__(self, rules=None):
+        rules = {**DEFAULT_URL_RULES, **(rules or {})}
+        self.default = HostBackend()
+        self.domains = {}  # суффикс домена -> backend
+        self.host_cache = {}
+        for backend_class in self.backend_classes:
+            self.register(backend_class(), rules[backend_class.rules_key])
+
+    def register(self, backend, domains):
+        for domain in domains:
+            self.domains[domain.lower().strip(".")] = backend
+        self.host_cache.clear()
+
+    def for_url(self, url):
+        """
+        Backend для ссылки; нужные ему модули импортируются при первом вызове.
+        """
+        host = (urlparse(url).hostname or "").lower()
+        backend = self.host_cache.get(host)
+        if backend is None:
+            backend = match_domain(self.domains, host) or self.default
+            self.host_cache[host] = backend
+        return backend.load()
+
+
+_backends = BackendRegistry()
+
+
+def get_backend(url):
+    """
+    Возвращает backend, который скачивает ссылку (BackendRegistry).
+    """
+    return _backends.for_url(url)
+
+
+def download_yandex_link(url, message_id, dest_dir, replace_path=None):
+    """
+    Скачивает публичный файл Яндекс.Диска под его настоящим именем.
+    Публичная папка скачивается целиком в одноименную подпапку.
+    Если задан replace_path, файл или папка заменяют его на месте.
+    """
+    # Определяем имя файла
+    file_name = get_filename_from_url_improved(url, message_id)
 
+    # Проверяем, нужно ли игнорировать этот файл
+    if should_ignore_file(file_name):
+        print(f"Игнорируем файл: {file_name}")
+        return None, None, {}
 
-def get_unique_filename(dest_path):
+    if is_yandex_folder(url):
+        return download_yandex_folder(url, dest_dir, file_name, replace_path)
+
+    if replace_path:
+        print(f"Обновляю: {replace_path}")
+        success, final_path, result = _download_yandex_file(
+            url, replace_path, keep_name=True
+        )
+    else:
+        # Резервируем уникальное имя файла, чтобы параллельные загрузки
+        # не выбрали одно и то же
+        dest_path = reserve_unique_filename(os.path.join(dest_dir, file_name))
+        print(f"Скачиваю в: {dest_path}")
+        try:
+            success, final_path, result = _download_yandex_file(url, dest_path)
+        finally:
+            release_filename(dest_path)
+    if not success:
+        return False, None, {}
+    info = {
+        "size": result.size,
+        "sha256": result.sha256,
+        "etag": result.etag,
+        "last_modified": result.last_modified,
+    }
+    return True, final_path, info
+
+
+def download_http_link(url, message_id, dest_dir, replace_path=None):
     """
-    Возвращает уникальное имя файла, добавляя (01), (02) и т.д. при необходимости.
+    Скачивает ссылку за один запрос: тело пишется в .part файл,
+    а <title> читается из первых байт ответа. Имя файла выбирается
+    после скачивания: из content-disposition, по title или по URL.
+    Если задан replace_path, готовый файл заменяет его на месте.
+
+    Если скачивание прервалось, .part файл остается в папке месяца
+    и при следующем запуске докачивается с места обрыва.
     """
-    if not os.path.exists(dest_path):
-        return dest_path
+    want_title = is_likely_html_page(url)
+    # Имя .part файла зависит только от URL, чтобы повторный запуск нашел его
+    part_path = reserve_part_filename(os.path.join(dest_dir, get_part_filename(url)))
+    print(f"Скачиваю в: {dest_dir}")
 
-    base_path, ext = os.path.splitext(dest_path)
-    counter = 1
+    try:
+        result = fetch_to_file(
+            url, part_path, title_limit=_http_config["title_bytes"] if want_title else 0
+        )
+        if not result.success:
+            return False, None, {}
+        info = {
+            "size": result.size,
+            "sha256": result.sha256,
+            "etag": result.etag,
+            "last_modified": result.last_modified,
+        }
+        if replace_path:
+            os.replace(part_path, replace_path)
+            return True, replace_path, info
 
-    while counter < 100:  # Ограничение до (99)
-        new_path = f"{base_path} ({counter:02d}){ext}"
-        if not os.path.exists(new_path):
-            return new_path
-        counter += 1
+        if result.filename:
+            file_name = result.filename
+        elif result.title:
+            file_name = sanitize_filename(f"{result.title}.html")
+        else:
+            file_name = get_fallback_filename(url, message_id)
 
-    # Если дошли до 100, используем timestamp
-    import time
+        # Проверяем, нужно ли игнорировать этот файл
+        if should_ignore_file(file_name):
+            print(f"Игнорируем файл: {file_name}")
+            os.remove(part_path)
+            return None, None, {}
 
-    timestamp = int(time.time())
-    return f"{base_path} ({timestamp}){ext}"
+        dest_path = reserve_unique_filename(os.path.join(dest_dir, file_name))
+        try:
+            os.replace(part_path, dest_path)
+        finally:
+            release_filename(dest_path)
+        return True, dest_path, info
+    finally:
+        release_filename(part_path)
 
 
-def should_ignore_file(filename):
+def hash_file(path, chunk_size=1024 * 1024):
     """
-    Проверяет, нужно ли игнорировать файл.
+    Считает SHA-256 файла.
     """
-    return filename in IGNORED_FILES
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
 
 
-def collect_links_from_messages(messages):
+def get_part_filename(url):
     """
-    Собирает все ссылки из сообщений и возвращает их список.
+    Имя скрытого .part файла для недокачанного URL.
     """
-    links = []
-    for message in messages:
-        text_entities = message.get("text_entities", [])
-        for entity in text_entities:
-            url = None
-            if entity.get("type") == "link":
-                url = entity.get("text")
-            elif entity.get("type") == "text_link":
-                url = entity.get("href")
-
-            if url and url.startswith(("http://", "https://")):
-                # Получаем дату сообщения для контекста
-                date_str = message.get("date")
-                if date_str:
-                    date_obj = datetime.fromisoformat(date_str)
-                    date_folder = date_obj.strftime("%Y-%m")
-                    links.append(f"{date_folder}: {url}")
-                else:
-                    links.append(url)
-    return links
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return f"{PART_PREFIX}{digest}{PART_SUFFIX}"
 
 
-def find_and_process_files(
-    json_file_path, target_dir, download_files=False, collect_links=True
-):
+def _read_part_meta(meta_path):
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove_part(part_path):
+    for path in (part_path, part_path + ".json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+_TITLE_RE = re.compile(r"<title[^>]*>([^<]+)</title>", re.IGNORECASE)
+_TITLE_END_RE = re.compile(rb"</title", re.IGNORECASE)
+_HEADER_CHARSET_RE = re.compile(r"charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+_META_CHARSET_RE = re.compile(rb"<meta[^>]+charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+_BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+
+def _known_charset(name):
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+
+def detect_head_charset(head, content_type=None):
     """
-    Главная функция для обработки JSON-экспорта Telegram.
+    Определяет кодировку HTML-документа только по его началу: BOM,
+    charset из Content-Type, затем <meta charset>. По умолчанию utf-8.
+    """
+    for bom, name in _BOMS:
+        if head.startswith(bom):
+            return name
+    match = _HEADER_CHARSET_RE.search(content_type or "")
+    if match and _known_charset(match.group(1)):
+        return match.group(1)
+    match = _META_CHARSET_RE.search(head)
+    if match and _known_charset(match.group(1).decode("ascii")):
+        return match.group(1).decode("ascii")
+    return "utf-8"
 
-    Args:
-        json_file_path: путь к JSON файлу с экспортом
-        target_dir: целевая директория для сохранения
-        download_files: флаг - скачивать ли файлы по ссылкам
-        collect_links: флаг - собирать ли ссылки в файл
+
+def extract_html_title(head, content_type=None):
     """
+    Извлекает <title> из начала HTML-документа (bytes). Кодировка
+    определяется по этому же началу и заголовку Content-Type.
+    """
+    text = head.decode(detect_head_charset(head, content_type), errors="replace")
+    title_match = _TITLE_RE.search(text)
+    if title_match:
+        title = title_match.group(1).strip()
+        # Используем функцию sanitize_filename для очистки
+        return sanitize_filename(title) or None
+    return None
 
-    # Списки для отслеживания результатов скачивания
-    skipped_links = []  # Пропущенные ссылки (соцсети и т.д.)
-    error_links = []  # Ссылки с ошибками скачивания
-    # Определяем директорию, где находится JSON-файл.
-    # Это нужно, чтобы правильно находить локальные файлы из экспорта (photos/, files/ и т.д.)
-    export_base_dir = os.path.dirname(os.path.abspath(json_file_path))
 
-    # Загружаем данные из JSON-файла
+def get_filename_from_headers(headers):
+    """
+    Пытается получить имя файла из заголовка content-disposition.
+    """
+    content_disposition = headers.get("content-disposition", "")
+    if content_disposition:
+        filename_match = re.findall(
+            r'filename[*]?=["\']?([^"\';\r\n]*)', content_disposition
+        )
+        if filename_match:
+            return sanitize_filename(filename_match[0])
+    return None
+
+
+def download_with_progress(url, dest_path, chunk_size=None):
+    """
+    Скачивает файл с отображением прогресса.
+    Файл пишется в dest_path + ".part" и переименовывается после
+    полного скачивания.
+    """
+    part_path = dest_path + PART_SUFFIX
+    result = fetch_to_file(url, part_path, chunk_size)
+    if result.success:
+        os.replace(part_path, dest_path)
+    return result.success, result.filename
+
+
+# Результат fetch_to_file
+FetchResult = namedtuple(
+    "FetchResult", "success filename title size sha256 etag last_modified"
+)
+FETCH_FAILED = FetchResult(False, None, None, 0, None, None, None)
+
+
+def fetch_to_file(
+    url, part_path, chunk_size=None, title_limit=0, resume_key=None, expected_size=None
+):
+    """
+    Скачивает ответ в .part файл с отображением прогресса.
+
+    Если part_path уже существует и для него сохранены ETag или
+    Last-Modified, запрашивается только недостающий хвост (Range + If-Range).
+    Если сервер вернул весь файл, скачивание начинается заново. Успехом
+    считается только получение всех байт из content-length; иначе .part
+    файл остается для докачки.
+
+    Если title_limit > 0, из первых title_limit байт ответа извлекается
+    <title> - без отдельного запроса.
+
+    Большие файлы с Accept-Ranges качаются по частям в несколько
+    соединений (_fetch_segmented). chunk_size - начальный размер буфера
+    чтения (по умолчанию STREAM_BUFFER_MIN, дальше он растет сам).
+
+    resume_key - ключ, по которому .part файл связывается с источником
+    (по умолчанию url; нужен, когда прямая ссылка меняется от запуска
+    к запуску). expected_size - размер файла, если он известен заранее,
+    а сервер не прислал content-length.
+
+    Попутно считается SHA-256 содержимого. Временные ошибки повторяются
+    (call_with_retries); повтор докачивает уже полученную часть.
+
+    Возвращает FetchResult.
+    """
+    started = time.monotonic()
     try:
-        with open(json_file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        print(f"Ошибка: JSON-файл '{json_file_path}' не найден.")
-        return
-    except json.JSONDecodeError:
-        print(
-            f"Ошибка: Не удалось прочитать JSON-файл '{json_file_path}'. Проверьте его формат."
+        return call_with_retries(
+            lambda: _fetch_attempt(
+                url, part_path, chunk_size, title_limit, resume_key, expected_size
+            ),
+            url,
         )
-        return
+    except Exception as e:
+        print(f"Ошибка скачивания {url}: {e}")
+        # Пустой .part файл докачивать нечего
+        if os.path.exists(part_path) and os.path.getsize(part_path) == 0:
+            _remove_part(part_path)
+        return FETCH_FAILED
+    finally:
+        _metrics.add_time("body", time.monotonic() - started)
 
-    # Создаем основную папку для загрузок, если ее нет
-    os.makedirs(target_dir, exist_ok=True)
-    print(f"Файлы будут сохранены в папку: '{os.path.abspath(target_dir)}'")
 
-    messages = data.get("messages", [])
-    if not messages:
-        print("В JSON-файле не найдено сообщений.")
+def _fetch_attempt(url, part_path, chunk_size, title_limit, resume_key, expected_size):
+    # Одна попытка fetch_to_file; ошибки выбрасываются
+    meta_path = part_path + ".json"
+    resume_key = resume_key or url
+    meta = None
+    offset = 0
+    if os.path.exists(part_path):
+        meta = _read_part_meta(meta_path)
+        if meta and meta.get("url") == resume_key and meta.get("segments"):
+            # Недокачанные части сегментированного скачивания
+            return _fetch_segmented(url, part_path, meta)
+        if meta and meta.get("url") == resume_key and meta.get("validator"):
+            offset = os.path.getsize(part_path)
+
+    headers = {}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = meta["validator"]
+        # Смещения Range относятся к несжатому телу
+        headers["Accept-Encoding"] = "identity"
+
+    response = http_get(url, stream=True, allow_redirects=True, headers=headers)
+
+    # Файл уже был скачан целиком, осталось только переименовать
+    if response.status_code == 416 and offset and offset == meta.get("total"):
+        response.close()
+        _remove_part_meta(meta_path)
+        title = _read_part_title(part_path, title_limit, None)
+        return FetchResult(
+            True,
+            meta.get("filename"),
+            title,
+            offset,
+            hash_file(part_path),
+            meta.get("etag"),
+            meta.get("last_modified"),
+        )
+
+    if response.status_code >= 400:
+        # Соединение возвращаем в пул сразу: запрос может быть повторен
+        response.close()
+        response.raise_for_status()
+
+    if response.status_code == 206 and _content_range_start(response) == offset:
+        print(f"Докачиваю с {format_file_size(offset)}")
+        mode = "ab"
+    else:
+        offset = 0
+        mode = "wb"
+
+    # Получаем размер файла из заголовков
+    content_length = int(response.headers.get("content-length", 0))
+    total_size = offset + content_length if content_length else 0
+    if not total_size and expected_size:
+        total_size = expected_size
+    encoded = response.headers.get("content-encoding", "identity") != "identity"
+
+    # Пытаемся получить имя файла из заголовков
+    filename_from_header = get_filename_from_headers(response.headers)
+    if not filename_from_header and mode == "ab":
+        filename_from_header = meta.get("filename")
+
+    # Валидаторы нужны, чтобы докачать файл, только если он не изменился.
+    # Слабый ETag для If-Range не подходит
+    etag = response.headers.get("etag", "")
+    last_modified = response.headers.get("last-modified")
+    validator = None
+    if etag and not etag.startswith("W/"):
+        validator = etag
+    elif response.headers.get("last-modified"):
+        validator = response.headers.get("last-modified")
+    if validator and not encoded:
+        part_meta = {
+            "url": resume_key,
+            "validator": validator,
+            "total": total_size,
+            "filename": filename_from_header,
+            "etag": etag or None,
+            "last_modified": last_modified,
+        }
+        parts = _segment_count(response, content_length, title_limit)
+        if mode == "wb" and parts > 1:
+            part_meta["segments"] = _split_segments(total_size, parts)
+            return _fetch_segmented(url, part_path, part_meta, response)
+        _write_part_meta(meta_path, part_meta)
+    else:
+        _remove_part_meta(meta_path)
+
+    size_str = format_file_size(total_size) if total_size > 0 else "неизвестен"
+    print(f"Скачиваю: размер {size_str}")
+
+    hasher = hashlib.sha256()
+    if mode == "ab":
+        # Уже скачанное начало файла тоже должно войти в хэш
+        with open(part_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+
+    downloaded = offset
+    with open(part_path, mode) as f, tqdm(
+        total=total_size or None,
+        initial=offset,
+        unit="B",
+        unit_scale=True,
+        desc="Скачивание",
+        disable=total_size <= 0,
+    ) as pbar:
+        # Прогресс-бар показываем только для файлов с известным размером
+        for chunk in iter_response_buffers(response, chunk_size):
+            f.write(chunk)
+            hasher.update(chunk)
+            downloaded += len(chunk)
+            pbar.update(len(chunk))
+
+    # При сжатой передаче content-length описывает сжатое тело
+    if total_size and not encoded and downloaded != total_size:
+        raise IncompleteDownload(
+            f"получено {format_file_size(downloaded)} из {format_file_size(total_size)}"
+        )
+
+    _remove_part_meta(meta_path)
+    title = _read_part_title(
+        part_path, title_limit, response.headers.get("content-type")
+    )
+    return FetchResult(
+        True,
+        filename_from_header,
+        title,
+        downloaded,
+        hasher.hexdigest(),
+        etag or None,
+        last_modified,
+    )
+
+
+def iter_response_buffers(response, buffer_size=None, limit=None):
+    """
+    Читает тело ответа (не больше limit байт) в переиспользуемый буфер
+    через readinto и выдает memoryview прочитанной части. Буфер растет
+    от STREAM_BUFFER_MIN до STREAM_BUFFER_MAX, пока чтения заполняют его
+    целиком. Выданный кусок действителен только до следующей итерации.
+
+    Сжатые ответы распаковываются через iter_content. Полученные байты
+    учитываются в метриках хоста.
+    """
+    received = 0
+    try:
+        for chunk in _read_response_buffers(response, buffer_size, limit):
+            received += len(chunk)
+            yield chunk
+    finally:
+        if received:
+            host = urlparse(getattr(response, "url", None) or "").netloc.lower()
+            _metrics.add_bytes(host, received)
+
+
+def _read_response_buffers(response, buffer_size, limit):
+    size = buffer_size or STREAM_BUFFER_MIN
+    raw = getattr(response, "raw", None)
+    encoded = response.headers.get("content-encoding", "identity") != "identity"
+    if encoded or not hasattr(raw, "readinto"):
+        remaining = limit
+        for chunk in response.iter_content(chunk_size=size):
+            if remaining is not None:
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+            if chunk:
+                yield chunk
+            if remaining == 0:
+                return
         return
 
-    # Список ключей, которые могут содержать пути к локальным файлам
-    file_keys = [
-        "file",
-        "photo",
-        "video_file",
-        "voice_message",
-        "audio_file",
-        "sticker_emoji",
+    buffer = memoryview(bytearray(size))
+    remaining = limit
+    while remaining is None or remaining > 0:
+        want = len(buffer) if remaining is None else min(len(buffer), remaining)
+        # Обрыв соединения посреди тела: urllib3 бросает свои исключения, а
+        # не requests.RequestException. Приводим их к IncompleteDownload,
+        # чтобы скачивание повторилось и докачалось
+        try:
+            read = raw.readinto(buffer[:want])
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            raise IncompleteDownload(f"соединение прервано: {e}") from e
+        if not read:
+            return
+        if remaining is not None:
+            remaining -= read
+        yield buffer[:read]
+        if read == len(buffer) and len(buffer) < STREAM_BUFFER_MAX:
+            buffer = memoryview(bytearray(len(buffer) * 2))
+
+
+class _SourceChanged(IncompleteDownload):
+    """
+    Файл на сервере изменился во время сегментированного скачивания.
+    """
+
+
+def _segment_count(response, content_length, title_limit):
+    # На сколько частей делить ответ; 1 - качать одним потоком
+    if title_limit or content_length < SEGMENT_MIN_SIZE:
+        return 1
+    if response.headers.get("accept-ranges", "").lower() != "bytes":
+        return 1
+    return max(1, min(_http_config["segments"], content_length // SEGMENT_MIN_PART))
+
+
+def _split_segments(total_size, parts):
+    # Диапазоны [начало, конец) равного размера
+    step = -(-total_size // parts)
+    return [
+        [start, min(start + step, total_size)] for start in range(0, total_size, step)
     ]
 
-    # --- 1. Обработка прикрепленных файлов ---
-    print("\n--- Шаг 1: Поиск и копирование прикрепленных файлов ---")
-    for message in tqdm(messages, desc="Обработка сообщений (файлы)"):
-        # Проверяем, есть ли в сообщении прикрепленный файл
-        file_path_relative = None
-        for key in file_keys:
-            if key in message and isinstance(message[key], str):
-                file_path_relative = message[key]
-                break
 
-        if file_path_relative:
-            # Получаем дату сообщения
-            date_str = message.get("date")
-            if not date_str:
-                continue
+def _fetch_segmented(url, part_path, meta, first_response=None):
+    """
+    Сегментированное скачивание: .part файл создается сразу нужного
+    размера, части качаются параллельно (Range + If-Range) и пишутся
+    каждая по своему смещению. Прогресс частей хранится в .part.json,
+    поэтому повтор докачивает только недостающее.
 
-            # Форматируем дату в YYYY-MM
-            date_obj = datetime.fromisoformat(date_str)
-            date_folder = date_obj.strftime("%Y-%m")
+    first_response - уже открытый ответ на весь файл: из него читается
+    первая часть.
+    """
+    meta_path = part_path + ".json"
+    total_size = meta["total"]
+    segments = meta["segments"]
+    if first_response is not None:
+        _preallocate(part_path, total_size)
+    _write_part_meta(meta_path, meta)
 
-            # Собираем полный путь к исходному файлу
-            source_path = os.path.join(export_base_dir, file_path_relative)
+    pending = [segment for segment in segments if segment[0] < segment[1]]
+    remaining = sum(end - start for start, end in pending)
+    print(f"Скачиваю: размер {format_file_size(total_size)}, частей: {len(pending)}")
 
-            # Проверяем, существует ли файл
-            if not os.path.exists(source_path):
-                # print(f"Предупреждение: Файл не найден по пути: {source_path}")
-                continue
+    progress_lock = threading.Lock()
+    errors = []
+    with tqdm(
+        total=total_size,
+        initial=total_size - remaining,
+        unit="B",
+        unit_scale=True,
+        desc="Скачивание",
+    ) as pbar:
 
-            # Создаем папку для сохранения с датой
-            dest_dir = os.path.join(target_dir, date_folder)
-            os.makedirs(dest_dir, exist_ok=True)
+        def progress(size):
+            with progress_lock:
+                pbar.update(size)
 
-            # Копируем файл с сохранением оригинального имени
-            file_name = os.path.basename(file_path_relative)
-            dest_path = os.path.join(dest_dir, file_name)
-
-            # Копируем, только если файл еще не существует
-            if not os.path.exists(dest_path):
-                shutil.copy2(source_path, dest_path)
-                # print(f"Скопирован: {file_name} -> {dest_dir}")
-
-    # --- 2. Сбор ссылок из сообщений ---
-    if collect_links:
-        print("\n--- Шаг 2: Сбор ссылок из сообщений ---")
-        links = collect_links_from_messages(messages)
-
-        if links:
-            links_file_path = os.path.join(target_dir, "links.txt")
-            with open(links_file_path, "w", encoding="utf-8") as f:
-                for link in links:
-                    f.write(link + "\n")
-            print(f"Сохранено {len(links)} ссылок в файл: {links_file_path}")
-        else:
-            print("Ссылки в сообщениях не найдены.")
+        with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+            futures = [
+                executor.submit(
+                    _fetch_segment,
+                    url,
+                    part_path,
+                    segment,
+                    meta["validator"],
+                    first_response if segment[0] == 0 else None,
+                    progress,
+                )
+                for segment in pending
+            ]
+        for future in futures:
+            if future.exception():
+                errors.append(future.exception())
+    if any(isinstance(e, _SourceChanged) for e in errors):
+        _remove_part(part_path)
+        raise errors[0]
+    if errors:
+        # Сохраняем, какие байты уже получены
+        _write_part_meta(meta_path, meta)
+        raise errors[0]
 
-    # --- 3. Скачивание файлов по ссылкам (только если флаг download_files установлен) ---
-    if download_files:
-        print("\n--- Шаг 3: Скачивание файлов по ссылкам ---")
-        for message in tqdm(messages, desc="Обработка сообщений (скачивание)"):
-            text_entities = message.get("text_entities", [])
-            for entity in text_entities:
-                url = None
-                if entity.get("type") == "link":
-                    url = entity.get("text")
-                elif entity.get("type") == "text_link":
-                    url = entity.get("href")
-
-                if url and url.startswith(("http://", "https://")):
-                    # Пропускаем ссылки на соцсети и видеохостинги, которые не являются прямыми файлами
-                    if any(domain in url for domain in SKIPPED_DOMAINS):
-                        # Получаем дату для контекста
-                        date_str = message.get("date")
-                        if date_str:
-                            date_obj = datetime.fromisoformat(date_str)
-                            date_folder = date_obj.strftime("%Y-%m")
-                            skipped_links.append(f"{date_folder}: {url}")
-                        else:
-                            skipped_links.append(url)
-                        continue
-
-                    # Получаем дату сообщения
-                    date_str = message.get("date")
-                    if not date_str:
-                        continue
-
-                    # Форматируем дату
-                    date_obj = datetime.fromisoformat(date_str)
-                    date_folder = date_obj.strftime("%Y-%m")
-
-                    # Создаем папку для сохранения
-                    dest_dir = os.path.join(target_dir, date_folder)
-                    os.makedirs(dest_dir, exist_ok=True)
-
-                    # Определяем имя файла
-                    file_name = get_filename_from_url_improved(url, message["id"])
-
-                    # Проверяем, нужно ли игнорировать этот файл
-                    if should_ignore_file(file_name):
-                        print(f"Игнорируем файл: {file_name}")
-                        continue
-
-                    # Создаем уникальное имя файла, если такой уже существует
-                    initial_dest_path = os.path.join(dest_dir, file_name)
-                    dest_path = get_unique_filename(initial_dest_path)
-
-                    print(f"\nНайдена ссылка: {url}")
-                    print(f"Скачиваю в: {dest_path}")
-
-                    success = False
-                    final_path = dest_path
-
-                    # Специальная обработка для Яндекс.Диска
-                    if is_yandex_disk_link(url):
-                        success, final_path = download_yandex_disk_file_with_progress(
-                            url, dest_path
-                        )
-                    else:
-                        # Обычное скачивание для других ссылок
-                        success, header_filename = download_with_progress(
-                            url, dest_path
-                        )
-
-                        # Если получили имя файла из заголовков, переименовываем
-                        if success and header_filename:
-                            # Проверяем, нужно ли игнорировать файл по новому имени
-                            if should_ignore_file(header_filename):
-                                print(f"Игнорируем файл: {header_filename}")
-                                if os.path.exists(dest_path):
-                                    os.remove(dest_path)
-                                continue
-
-                            new_dest_path = os.path.join(dest_dir, header_filename)
-                            new_dest_path = get_unique_filename(new_dest_path)
-                            if dest_path != new_dest_path:
-                                os.rename(dest_path, new_dest_path)
-                                final_path = new_dest_path
-                                print(f"Переименован в: {new_dest_path}")
-
-                    if success:
-                        try:
-                            file_size = os.path.getsize(final_path)
-                            file_size_mb = file_size / (1024 * 1024)
-                            final_file_name = os.path.basename(final_path)
-                            print(
-                                f"✓ Скачан: {final_file_name} ({file_size_mb:.2f} МБ)"
-                            )
-                        except:
-                            final_file_name = os.path.basename(final_path)
-                            print(f"✓ Скачан: {final_file_name}")
-                    else:
-                        print(f"✗ Ошибка скачивания: {url}")
-                        # Добавляем ссылку с ошибкой в список
-                        error_links.append(f"{date_folder}: {url}")
+    downloaded = os.path.getsize(part_path)
+    if downloaded != total_size:
+        raise IncompleteDownload(
+            f"получено {format_file_size(downloaded)} из {format_file_size(total_size)}"
+        )
 
-    print("\nГотово! Все найденные файлы обработаны.")
+    _remove_part_meta(meta_path)
+    return FetchResult(
+        True,
+        meta.get("filename"),
+        None,
+        total_size,
+        hash_file(part_path),
+        meta.get("etag"),
+        meta.get("last_modified"),
+    )
 
-    # --- 4. Сохранение списков пропущенных и неудачных ссылок ---
-    if download_files:
-        if skipped_links:
-            skipped_file_path = os.path.join(target_dir, "skipped.txt")
-            with open(skipped_file_path, "w", encoding="utf-8") as f:
-                for link in skipped_links:
-                    f.write(link + "\n")
-            print(
-                f"Сохранено {len(skipped_links)} пропущенных ссылок в файл: {skipped_file_path}"
-            )
 
-        if error_links:
-            error_file_path = os.path.join(target_dir, "errors.txt")
-            with open(error_file_path, "w", encoding="utf-8") as f:
-                for link in error_links:
-                    f.write(link + "\n")
-            print(
-                f"Сохранено {len(error_links)} ссылок с ошибками в файл: {error_file_path}"
-            )
+def _fetch_segment(url, part_path, segment, validator, response, progress):
+    # Качает диапазон segment = [начало, конец) в part_path; segment[0]
+    # сдвигается по мере записи
+    if response is None:
+        response = http_get(
+            url,
+            stream=True,
+            allow_redirects=True,
+            headers={
+                "Range": f"bytes={segment[0]}-{segment[1] - 1}",
+                "If-Range": validator,
+                "Accept-Encoding": "identity",
+            },
+        )
+        if response.status_code == 200:
+            response.close()
+            raise _SourceChanged("файл на сервере изменился, скачиваю заново")
+        if response.status_code >= 400:
+            response.close()
+            response.raise_for_status()
+        if _content_range_start(response) != segment[0]:
+            response.close()
+            raise IncompleteDownload("сервер вернул не тот диапазон байт")
+
+    try:
+        with open(part_path, "r+b") as f:
+            f.seek(segment[0])
+            for chunk in iter_response_buffers(response, limit=segment[1] - segment[0]):
+                f.write(chunk)
+                segment[0] += len(chunk)
+                progress(len(chunk))
+    finally:
+        response.close()
+
+    if segment[0] < segment[1]:
+        raise IncompleteDownload(
+            f"часть файла оборвалась на {format_file_size(segment[0])}"
+        )
+
+
+def _preallocate(path, size):
+    # Выделяет место под файл заранее; где нельзя - создает разреженный файл
+    with open(path, "wb") as f:
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError:
+                pass
+        f.truncate(size)
 
-        if not skipped_links and not error_links:
-            print("Все ссылки успешно обработаны - нет пропущенных или ошибок!")
 
+def _write_part_meta(meta_path, meta):
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
 
-def download_with_progress(url, dest_path, chunk_size=8192):
+
+def _content_range_start(response):
+    match = re.match(r"bytes (\d+)-", response.headers.get("content-range", ""))
+    return int(match.group(1)) if match else None
+
+
+def _remove_part_meta(meta_path):
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+
+def _read_part_title(part_path, title_limit, content_type):
+    if not title_limit:
+        return None
+    started = time.monotonic()
+    with open(part_path, "rb") as f:
+        head = f.read(title_limit)
+    title = extract_html_title(head, content_type) if head else None
+    _metrics.add_time("title", time.monotonic() - started)
+    return title
+
+
+# Схема, хост (без логина и порта) и путь URL
+_URL_PARTS_RE = re.compile(
+    r"^[A-Za-z][A-Za-z0-9+.-]*://(?:[^/?#@]*@)?(\[[^\]]*\]|[^/?#:]*)(?::\d*)?([^?#]*)"
+)
+
+
+def match_domain(domains, host):
     """
-    Скачивает файл с отображением прогресса.
+    Значение из словаря domains для самого длинного суффикса домена
+    host ("a.b.c" -> "a.b.c", "b.c", "c") или None.
     """
-    try:
-        response = requests.get(url, stream=True, timeout=10, allow_redirects=True)
-        response.raise_for_status()
+    suffix = host
+    while suffix:
+        value = domains.get(suffix)
+        if value:
+            return value
+        dot = suffix.find(".")
+        suffix = suffix[dot + 1 :] if dot >= 0 else ""
+    return None
 
-        # Получаем размер файла из заголовков
-        total_size = int(response.headers.get("content-length", 0))
 
-        # Пытаемся получить имя файла из заголовков
-        content_disposition = response.headers.get("content-disposition", "")
-        filename_from_header = None
-        if content_disposition:
-            filename_match = re.findall(
-                r'filename[*]?=["\']?([^"\';\r\n]*)', content_disposition
-            )
-            if filename_match:
-                filename_from_header = sanitize_filename(filename_match[0])
-
-        size_str = format_file_size(total_size) if total_size > 0 else "неизвестен"
-        print(f"Скачиваю: размер {size_str}")
-
-        with open(dest_path, "wb") as f:
-            if total_size > 0:
-                # Показываем прогресс-бар для файлов с известным размером
-                with tqdm(
-                    total=total_size, unit="B", unit_scale=True, desc="Скачивание"
-                ) as pbar:
-                    downloaded = 0
-                    for chunk in response.iter_content(chunk_size=chunk_size):
-                        if chunk:
-                            f.write(chunk)
-                            downloaded += len(chunk)
-                            pbar.update(len(chunk))
-            else:
-                # Простое скачивание без прогресс-бара
-                downloaded = 0
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded += len(chunk)
+class UrlClassifier:
+    """
+    Классификатор ссылок, собираемый один раз из правил (DEFAULT_URL_RULES).
 
-        return True, filename_from_header
+    Хост ссылки сравнивается с доменами правил по суффиксу через словарь,
+    тип по хосту кэшируется, а расширение файла ищется во множестве,
+    поэтому классификация не перебирает списки подстрок.
+    """
+
+    def __init__(self, rules=None):
+        rules = {**DEFAULT_URL_RULES, **(rules or {})}
+        # Суффикс домена -> тип; при совпадении правил приоритет у skip
+        self.domains = {}
+        for key, kind in (
+            ("html_domains", LINK_HTML),
+            ("yandex_domains", LINK_YANDEX),
+            ("skip_domains", LINK_SKIP),
+        ):
+            for domain in rules[key]:
+                self.domains[domain.lower().strip(".")] = kind
+        self.html_extensions = frozenset(e.lower() for e in rules["html_extensions"])
+        self.file_extensions = frozenset(e.lower() for e in rules["file_extensions"])
+        self.html_path_markers = tuple(m.lower() for m in rules["html_path_markers"])
+        self.html_url_markers = tuple(m.lower() for m in rules["html_url_markers"])
+        self.host_cache = {}
+
+    def host_kind(self, host):
+        """
+        Тип по хосту (LINK_SKIP, LINK_YANDEX, LINK_HTML) или None.
+        """
+        kind = self.host_cache.get(host, False)
+        if kind is not False:
+            return kind
+        kind = match_domain(self.domains, host)
+        self.host_cache[host] = kind
+        return kind
+
+    def path_kind(self, url, path):
+        """
+        Тип по пути: LINK_FILE для известных расширений файлов,
+        иначе LINK_HTML.
+        """
+        path = path.lower()
+        # Если нет расширения файла или есть характерные для веб-страниц пути
+        if not path or path.endswith("/"):
+            return LINK_HTML
+        name = path[path.rfind("/") + 1 :]
+        dot = name.rfind(".")
+        ext = name[dot:] if dot >= 0 else ""
+        if ext in self.html_extensions:
+            return LINK_HTML
+        for marker in self.html_path_markers:
+            if marker in path:
+                return LINK_HTML
+        if self.html_url_markers:
+            lowered = url.lower()
+            for marker in self.html_url_markers:
+                if marker in lowered:
+                    return LINK_HTML
+        # Если есть расширение файла, но это не веб-страница
+        if ext in self.file_extensions:
+            return LINK_FILE
+        return LINK_HTML
+
+    def classify(self, url):
+        match = _URL_PARTS_RE.match(url)
+        if not match:
+            return LINK_HTML
+        kind = self.host_kind(match.group(1).lower())
+        if kind:
+            return kind
+        return self.path_kind(url, match.group(2))
+
+    def is_html_page(self, url):
+        """
+        HTML-страница или прямая ссылка на файл (правила skip и Яндекс.Диска
+        не учитываются).
+        """
+        match = _URL_PARTS_RE.match(url)
+        if not match:
+            return True
+        kind = self.host_kind(match.group(1).lower())
+        if kind == LINK_HTML:
+            return True
+        return self.path_kind(url, match.group(2)) == LINK_HTML
+
+    def classify_many(self, urls):
+        """
+        Пакетная классификация: возвращает список типов для списка URL.
+        """
+        match_url = _URL_PARTS_RE.match
+        host_cache = self.host_cache
+        host_kind = self.host_kind
+        path_kind = self.path_kind
+        kinds = []
+        append = kinds.append
+        for url in urls:
+            match = match_url(url)
+            if not match:
+                append(LINK_HTML)
+                continue
+            host = match.group(1).lower()
+            kind = host_cache.get(host, False)
+            if kind is False:
+                kind = host_kind(host)
+            append(kind or path_kind(url, match.group(2)))
+        return kinds
+
+
+def load_url_rules(path):
+    """
+    Загружает правила классификации ссылок из JSON-файла. Отсутствующие
+    ключи берутся из DEFAULT_URL_RULES.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        rules = json.load(f)
+    unknown = set(rules) - set(DEFAULT_URL_RULES)
+    if unknown:
+        raise ValueError(f"Неизвестные ключи правил: {', '.join(sorted(unknown))}")
+    return rules
+
+
+def configure_url_rules(rules=None):
+    """
+    Пересобирает классификатор ссылок и реестр backend'ов с новыми правилами.
+    """
+    global _url_classifier, _backends
+    _url_classifier = UrlClassifier(rules)
+    _backends = BackendRegistry(rules)
 
-    except Exception as e:
-        print(f"Ошибка скачивания {url}: {e}")
-        return False, None
+
+_url_classifier = UrlClassifier()
 
 
 def is_likely_html_page(url):
     """
     Определяет, является ли URL HTML-страницей (а не прямой ссылкой на файл).
     """
-    parsed_url = urlparse(url)
-    path = parsed_url.path.lower()
+    return _url_classifier.is_html_page(url)
 
-    # Если нет расширения файла или есть характерные для веб-страниц пути
-    if (
-        not path
-        or path.endswith("/")
-        or path.endswith(".html")
-        or path.endswith(".htm")
-        or "/edit" in path
-        or "/view" in path
-        or "sharing" in url.lower()
-        or "docs.google.com" in url.lower()
-        or "trafory.yonote.ru" in url.lower()
-        or "zoom.us" in url.lower()
-        or "github.com" in url.lower()
-        or "habr.com" in url.lower()
-        or "youtube.com" in url.lower()
-        or "youtu.be" in url.lower()
-        or "colab.research.google.com" in url.lower()
-    ):
-        return True
 
-    # Если есть расширение файла, но это не веб-страница
-    file_extensions = [
-        ".pdf",
-        ".doc",
-        ".docx",
-        ".xls",
-        ".xlsx",
-        ".zip",
-        ".rar",
-        ".mp4",
-        ".avi",
-        ".mkv",
-        ".mp3",
-        ".wav",
-        ".jpg",
-        ".png",
-        ".gif",
-    ]
-    if any(path.endswith(ext) for ext in file_extensions):
-        return False
+def canonicalize_url(url):
+    """
+    Приводит ссылку к каноническому виду для дедупликации: схема и хост
+    в нижнем регистре, без порта по умолчанию, без фрагмента и без
+    параметров отслеживания (utm_*, fbclid и т.п.). Путь и порядок
+    остальных параметров не меняются.
+    """
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url
+    if not parts.netloc:
+        return url
+
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").rstrip(".")
+    try:
+        host = host.encode("idna").decode("ascii")
+    except UnicodeError:
+        pass
+    if ":" in host:
+        host = f"[{host}]"
+    netloc = host
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{host}:{port}"
+    if parts.username is not None:
+        userinfo = parts.netloc.rpartition("@")[0]
+        netloc = f"{userinfo}@{netloc}"
+
+    query = "&".join(
+        pair
+        for pair in parts.query.split("&")
+        if pair and not _is_tracking_param(pair.split("=", 1)[0])
+    )
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+def _is_tracking_param(name):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def is_short_url(url):
+    """
+    Проверяет, ведет ли ссылка на сокращатель ссылок.
+    """
+    host = (urlsplit(url).hostname or "").rstrip(".")
+    return host in SHORTENER_DOMAINS
+
+
+# Кэш раскрытых коротких ссылок на время запуска
+_short_url_cache = {}
+_short_url_lock = threading.Lock()
+
+
+def resolve_short_url(url, timeout=None):
+    """
+    Раскрывает короткую ссылку по цепочке редиректов (HEAD-запросами,
+    без скачивания тела) и возвращает канонический конечный адрес.
+    При ошибке возвращается исходная ссылка.
+    """
+    with _short_url_lock:
+        hit = url in _short_url_cache
+        target = _short_url_cache.get(url)
+    _metrics.cache("short_url", hit)
+    if hit:
+        return target
+
+    target = url
+    try:
+        for _ in range(MAX_SHORTENER_HOPS):
+            if not is_short_url(target):
+                break
+            response = http_head(
+                target, allow_redirects=False, timeout=timeout or http_timeout()
+            )
+            response.close()
+            location = response.headers.get("location")
+            if not response.is_redirect or not location:
+                break
+            target = urljoin(target, location)
+    except Exception as e:
+        print(f"Не удалось раскрыть короткую ссылку {url}: {e}")
+        target = url
 
-    return True
+    target = canonicalize_url(target)
+    with _short_url_lock:
+        _short_url_cache[url] = target
+    return target
 
 
 def get_filename_from_url_improved(url, message_id):
@@ -436,13 +3816,29 @@ def get_filename_from_url_improved(url, message_id):
         if title:
             file_name = f"{title}.html"
         else:
-            # Используем домен и путь для создания понятного имени
-            domain = parsed_url.netloc.replace("www.", "")
-            path_part = parsed_url.path.strip("/").replace("/", "_")
-            if path_part:
-                file_name = f"{domain}_{path_part}.html"
-            else:
-                file_name = f"{domain}.html"
+            return get_fallback_filename(url, message_id)
+
+    if not file_name:  # Если имя файла не удалось извлечь
+        file_name = f"downloaded_file_{message_id}"
+
+    return sanitize_filename(file_name)
+
+
+def get_fallback_filename(url, message_id):
+    """
+    Имя файла по самому URL, без сетевых запросов.
+    """
+    parsed_url = urlparse(url)
+    file_name = os.path.basename(parsed_url.path)
+
+    if is_likely_html_page(url):
+        # Используем домен и путь для создания понятного имени
+        domain = parsed_url.netloc.replace("www.", "")
+        path_part = parsed_url.path.strip("/").replace("/", "_")
+        if path_part:
+            file_name = f"{domain}_{path_part}.html"
+        else:
+            file_name = f"{domain}.html"
 
     if not file_name:  # Если имя файла не удалось извлечь
         file_name = f"downloaded_file_{message_id}"
@@ -477,25 +3873,82 @@ def sanitize_filename(filename):
     return filename
 
 
-def get_html_title(url, timeout=10):
+def get_html_title(url, timeout=None, limit=None):
     """
     Получает title HTML страницы с правильной обработкой HTML entities.
+
+    Страница читается потоком и только до закрывающего </title> или
+    до limit байт (по умолчанию title_bytes из configure_http).
+    Временные ошибки повторяются.
     """
+    limit = limit or _http_config["title_bytes"]
+    started = time.monotonic()
+    try:
+        head, content_type = call_with_retries(
+            lambda: _read_html_head(url, timeout or http_timeout(), limit), url
+        )
+        title = extract_html_title(head, content_type)
+    except Exception:
+        return None
+    finally:
+        _metrics.add_time("title", time.monotonic() - started)
+    return title
+
+
+def _read_html_head(url, timeout, limit):
+    # Читает начало страницы до </title> или limit байт
+    response = http_get(
+        url,
+        stream=True,
+        timeout=timeout,
+        headers={"Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8"},
+    )
     try:
-        response = requests.get(url, timeout=timeout)
         response.raise_for_status()
+        head = bytearray()
+        for chunk in iter_response_buffers(response, TITLE_CHUNK_SIZE, limit):
+            # Тег мог разорваться между порциями - ищем с небольшим запасом
+            start = max(0, len(head) - 8)
+            head += chunk
+            if len(head) >= limit or _TITLE_END_RE.search(head, start):
+                break
+    finally:
+        response.close()
+    return bytes(head[:limit]), response.headers.get("content-type")
 
-        # Ищем title в HTML
-        content = response.text
-        title_match = re.search(r"<title[^>]*>([^<]+)</title>", content, re.IGNORECASE)
-        if title_match:
-            title = title_match.group(1).strip()
-            # Используем функцию sanitize_filename для очистки
-            title = sanitize_filename(title)
-            return title
-    except Exception:
-        pass
-    return None
+
+# Общий клиент Яндекс.Диска и кэш метаданных публичных ресурсов по URL
+_yandex_client = None
+_yandex_lock = threading.Lock()
+_yandex_meta_cache = {}
+
+
+def get_yandex_client():
+    """
+    Возвращает общий клиент Яндекс.Диска (создается один раз).
+    """
+    global _yandex_client
+    with _yandex_lock:
+        if _yandex_client is None:
+            _yandex_client = yadisk.Client()
+        return _yandex_client
+
+
+def get_yandex_public_meta(url):
+    """
+    Возвращает метаданные публичного ресурса Яндекс.Диска.
+    Успешный ответ кэшируется до конца запуска.
+    """
+    with _yandex_lock:
+        hit = url in _yandex_meta_cache
+        meta = _yandex_meta_cache.get(url)
+    _metrics.cache("yandex_meta", hit)
+    if hit:
+        return meta
+    meta = get_yandex_client().get_public_meta(url)
+    with _yandex_lock:
+        _yandex_meta_cache[url] = meta
+    return meta
 
 
 def get_yandex_disk_file_info(url):
@@ -503,9 +3956,8 @@ def get_yandex_disk_file_info(url):
     Получает информацию о файле с Яндекс.Диска (имя, размер).
     """
     try:
-        client = yadisk.Client()
         # Получаем метаданные публичного ресурса
-        meta = client.get_public_meta(url)
+        meta = get_yandex_public_meta(url)
 
         file_name = meta.name if hasattr(meta, "name") and meta.name else None
         file_size = meta.size if hasattr(meta, "size") and meta.size else None
@@ -516,6 +3968,33 @@ def get_yandex_disk_file_info(url):
         return None, None
 
 
+def fetch_yandex_to_file(url, part_path):
+    """
+    Скачивает публичный файл Яндекс.Диска в .part файл обычным потоковым
+    путем: прямая ссылка получается один раз, дальше работают прогресс,
+    докачка через Range и проверка размера. Если Яндекс.Диск сообщил
+    SHA-256 файла, содержимое сверяется с ним.
+
+    Возвращает FetchResult.
+    """
+    try:
+        meta = get_yandex_public_meta(url)
+        link = get_yandex_client().get_public_download_link(url)
+    except Exception as e:
+        print(f"Ошибка получения ссылки на скачивание с Яндекс.Диска {url}: {e}")
+        return FETCH_FAILED
+
+    result = fetch_to_file(
+        link, part_path, resume_key=url, expected_size=getattr(meta, "size", None)
+    )
+    expected_sha256 = getattr(meta, "sha256", None)
+    if result.success and expected_sha256 and result.sha256 != expected_sha256:
+        print(f"Контрольная сумма файла с Яндекс.Диска не совпала: {url}")
+        _remove_part(part_path)
+        return FETCH_FAILED
+    return result
+
+
 def format_file_size(size_bytes):
     """
     Форматирует размер файла в читаемый вид.
@@ -534,45 +4013,227 @@ def download_yandex_disk_file_with_progress(url, dest_path):
     """
     Скачивает файл с Яндекс.Диска с отображением прогресса.
     """
-    try:
-        client = yadisk.Client()
+    success, final_dest_path, _ = _download_yandex_file(url, dest_path)
+    return success, final_dest_path
 
+
+def _download_yandex_file(url, dest_path, keep_name=False):
+    # Возвращает (успех, итоговый путь, FetchResult). keep_name - не менять
+    # имя dest_path на имя файла на Диске
+    final_dest_path = dest_path
+    part_path = None
+    try:
         # Получаем информацию о файле
         file_name, file_size = get_yandex_disk_file_info(url)
 
-        if file_name:
+        if file_name and not keep_name:
             # Обновляем путь назначения с правильным именем файла
             dest_dir = os.path.dirname(dest_path)
             sanitized_name = sanitize_filename(file_name)
             initial_path = os.path.join(dest_dir, sanitized_name)
-            final_dest_path = get_unique_filename(initial_path)
-        else:
-            final_dest_path = dest_path
+            # Если имя совпало, оно уже зарезервировано под эту загрузку
+            if initial_path != dest_path:
+                final_dest_path = reserve_unique_filename(initial_path)
 
         size_str = format_file_size(file_size)
         print(f"Скачиваю с Яндекс.Диска: {file_name or 'файл'} ({size_str})")
 
-        # Удаляем файл, если он уже существует
-        if os.path.exists(final_dest_path):
-            os.remove(final_dest_path)
+        part_path = reserve_part_filename(
+            os.path.join(os.path.dirname(final_dest_path), get_part_filename(url))
+        )
+        result = fetch_yandex_to_file(url, part_path)
+        if not result.success:
+            return False, dest_path, result
 
-        # Скачиваем файл напрямую (yadisk API не поддерживает chunked download для публичных файлов)
-        print("Скачивание... (может занять некоторое время)")
-        client.download_public(url, final_dest_path)
+        os.replace(part_path, final_dest_path)
         print("✓ Скачивание завершено")
 
-        return True, final_dest_path
+        return True, final_dest_path, result
 
     except Exception as e:
         print(f"Ошибка скачивания с Яндекс.Диска {url}: {e}")
-        return False, dest_path
+        return False, dest_path, FETCH_FAILED
+    finally:
+        if part_path:
+            release_filename(part_path)
+        if final_dest_path != dest_path:
+            release_filename(final_dest_path)
+
+
+def is_yandex_folder(url):
+    """
+    Проверяет, указывает ли ссылка Яндекс.Диска на публичную папку.
+    """
+    try:
+        return getattr(get_yandex_public_meta(url), "type", None) == "dir"
+    except Exception:
+        return False
+
+
+def iter_yandex_public_folder(url, page_size=YANDEX_PAGE_SIZE):
+    """
+    Перебирает все файлы публичной папки Яндекс.Диска вместе с вложенными.
+    Содержимое запрашивается страницами по page_size элементов, и файлы
+    отдаются сразу, не дожидаясь обхода всего дерева.
+    """
+    client = get_yandex_client()
+    folders = deque(["/"])
+    while folders:
+        path = folders.popleft()
+        offset = 0
+        while True:
+            meta = client.get_public_meta(
+                url, path=path, limit=page_size, offset=offset
+            )
+            embedded = getattr(meta, "embedded", None)
+            items = list(getattr(embedded, "items", None) or [])
+            for item in items:
+                if item.type == "dir":
+                    folders.append(item.path)
+                else:
+                    yield item
+            if len(items) < page_size:
+                break
+            offset += page_size
+
+
+def download_yandex_folder(url, dest_dir, folder_name, replace_path=None):
+    """
+    Скачивает публичную папку Яндекс.Диска в dest_dir/folder_name, сохраняя
+    структуру подпапок.
+
+    Файлы сначала скачиваются в скрытую папку, имя которой зависит от
+    публичной ссылки: повторный запуск докачивает в нее только недостающее,
+    а уже скачанные файлы того же размера пропускаются. Готовая папка
+    получает уникальное имя, поэтому одноименные папки не смешиваются,
+    или заменяет папку replace_path, если та скачивается заново.
+
+    Файлы скачиваются по мере получения списка через планировщик текущего
+    запуска с его лимитами.
+
+    Возвращает (успех, путь к папке, информация для манифеста).
+    """
+    part_dir = reserve_part_filename(os.path.join(dest_dir, get_part_filename(url)))
+    try:
+        return _download_yandex_folder(url, part_dir, folder_name, replace_path)
+    finally:
+        release_filename(part_dir)
+
+
+def _download_yandex_folder(url, part_dir, folder_name, replace_path=None):
+    print(f"Скачиваю папку с Яндекс.Диска: {folder_name}")
+    lock = threading.Lock()
+    stats = {"files": 0, "skipped": 0, "failed": 0, "bytes": 0}
+
+    def task(item, dest_path):
+        try:
+            part_path = reserve_part_filename(
+                os.path.join(
+                    os.path.dirname(dest_path), get_part_filename(url + item.path)
+                )
+            )
+            try:
+                link = getattr(item, "file", None) or (
+                    get_yandex_client().get_public_download_link(url, path=item.path)
+                )
+                result = fetch_to_file(
+                    link,
+                    part_path,
+                    resume_key=f"{url}#{item.path}",
+                    expected_size=getattr(item, "size", None),
+                )
+                expected_sha256 = getattr(item, "sha256", None)
+                if (
+                    result.success
+                    and expected_sha256
+                    and result.sha256 != expected_sha256
+                ):
+                    print(f"Контрольная сумма не совпала: {item.path}")
+                    _remove_part(part_path)
+                    result = FETCH_FAILED
+                if result.success:
+                    os.replace(part_path, dest_path)
+            finally:
+                release_filename(part_path)
+        except Exception as e:
+            print(f"Ошибка скачивания {item.path} из {url}: {e}")
+            result = FETCH_FAILED
+
+        with lock:
+            if result.success:
+                stats["files"] += 1
+                stats["bytes"] += result.size
+            else:
+                stats["failed"] += 1
+
+    # Вне планировщика (например, при прямом вызове) файлы папки
+    # скачиваются собственным планировщиком
+    scheduler, host = DownloadScheduler.current()
+    own_scheduler = None
+    if scheduler is None:
+        own_scheduler = scheduler = DownloadScheduler(
+            YANDEX_FOLDER_JOBS, YANDEX_FOLDER_JOBS
+        )
+        host = urlparse(url).netloc.lower()
+    group = TaskGroup(scheduler, host, scheduler.per_host_jobs * 4)
+    try:
+        _filename_index.ensure_dir(part_dir)
+        for item in iter_yandex_public_folder(url):
+            parts = [sanitize_filename(p) for p in item.path.split("/") if p]
+            dest_path = os.path.join(part_dir, *parts)
+            size = getattr(item, "size", None)
+            if os.path.exists(dest_path) and os.path.getsize(dest_path) == size:
+                with lock:
+                    stats["skipped"] += 1
+                continue
+            _filename_index.ensure_dir(os.path.dirname(dest_path))
+            group.submit(lambda item=item, dest_path=dest_path: task(item, dest_path))
+    except Exception as e:
+        print(f"Ошибка получения содержимого папки {url}: {e}")
+        with lock:
+            stats["failed"] += 1
+    finally:
+        group.join()
+        if own_scheduler:
+            own_scheduler.join()
+
+    folder_path = None
+    if not stats["failed"] and replace_path:
+        # Папка на Диске изменилась: старая копия заменяется целиком
+        folder_path = replace_path
+        if os.path.isdir(folder_path):
+            shutil.rmtree(folder_path)
+        os.replace(part_dir, folder_path)
+        _filename_index.forget(part_dir)
+        _filename_index.forget(folder_path)
+    elif not stats["failed"]:
+        folder_path = reserve_unique_filename(
+            os.path.join(os.path.dirname(part_dir), folder_name)
+        )
+        try:
+            os.replace(part_dir, folder_path)
+        finally:
+            release_filename(folder_path)
+        _filename_index.forget(part_dir)
+    if stats["failed"]:
+        # Недокачанная папка докачивается в следующий раз: ошибки ее
+        # файлов случались в других потоках, считаем их временными
+        _last_failure.transient = True
+    print(
+        f"Папка {folder_name}: скачано {stats['files']} файлов "
+        f"({format_file_size(stats['bytes'])}), уже было {stats['skipped']}, "
+        f"ошибок {stats['failed']}"
+    )
+    if stats["failed"]:
+        return False, None, {}
+    return True, folder_path, {"size": stats["bytes"]}
 
 
 def is_yandex_disk_link(url):
     """
     Проверяет, является ли URL ссылкой на Яндекс.Диск.
     """
-    return "disk.yandex.ru" in url
+    return _url_classifier.classify(url) == LINK_YANDEX
 
 
 def download_yandex_disk_file(url, dest_path):
@@ -583,6 +4244,485 @@ def download_yandex_disk_file(url, dest_path):
     return download_yandex_disk_file_with_progress(url, dest_path)[0]
 
 
+def estimate_link(url, message_id):
+    """
+    Оценивает ссылку без скачивания: имя файла и размер в байтах.
+    Для Яндекс.Диска используются метаданные (для папки - сумма размеров
+    файлов), для остальных ссылок - HEAD-запрос. Имя HTML-страницы
+    станет известно только при скачивании (по <title>), поэтому для нее
+    возвращается имя по URL.
+
+    Возвращает (имя, размер или None, ошибка или None).
+    """
+    try:
+        if is_short_url(url):
+            url = resolve_short_url(url)
+        return get_backend(url).estimate(url, message_id)
+    except Exception as e:
+        return get_fallback_filename(url, message_id), None, str(e)
+
+
+def _estimate_http(url, message_id):
+    # Оценка по HEAD-запросу; ошибки сети выбрасываются
+    response = call_with_retries(lambda: http_head(url, allow_redirects=True), url)
+    response.close()
+
+    name = get_filename_from_headers(response.headers) or get_fallback_filename(
+        url, message_id
+    )
+    # Сервер без поддержки HEAD: размер неизвестен, но это не ошибка
+    if response.status_code in (405, 501):
+        return name, None, None
+    if response.status_code >= 400:
+        return name, None, f"HTTP {response.status_code}"
+    size = None
+    if response.headers.get("content-encoding", "identity") == "identity":
+        size = int(response.headers.get("content-length") or 0) or None
+    return name, size, None
+
+
+def plan_downloads(
+    json_file_path,
+    target_dir,
+    plan_path,
+    jobs=DEFAULT_JOBS,
+    per_host_jobs=DEFAULT_PER_HOST_JOBS,
+    use_manifest=True,
+    incremental=False,
+):
+    """
+    Составляет план скачивания (--plan) без записи файлов в target_dir:
+    разбирает и классифицирует ссылки, как шаг 3, и параллельно оценивает
+    размеры (HEAD-запросы и метаданные Яндекс.Диска) с теми же лимитами
+    на хост, что и при скачивании. Печатает объем по хостам и месяцам.
+
+    План сохраняется в plan_path в формате экспорта Telegram: в нем только
+    сообщения со ссылками для шага 3, а оценки лежат в поле "plan"
+    каждого сообщения и в сводке "plan" в конце файла. Поэтому план
+    выполняется обычным запуском: --source_file plan.json --download.
+
+    Манифест target_dir (если есть) открывается только на чтение и не
+    меняется: уже скачанные ссылки в оценку не входят.
+    """
+    manifest = None
+    manifest_path = os.path.join(target_dir, MANIFEST_FILENAME)
+    if use_manifest and os.path.exists(manifest_path):
+        manifest = Manifest(manifest_path, read_only=True)
+
+    header = read_export_header(json_file_path)
+    watermark = None
+    if incremental and manifest:
+        try:
+            watermark = manifest.watermark(export_chat_key(header, json_file_path))
+        except sqlite3.OperationalError:
+            # Манифест прошлой версии без таблицы отметок
+            pass
+
+    messages = []
+    skipped = []
+    seen = set()
+    seen_skipped = set()
+    scheduler = DownloadScheduler(jobs, per_host_jobs)
+
+    # Ошибка формата в середине файла не прерывает план: он составляется
+    # по сообщениям, прочитанным до нее
+    export_error = None
+
+    def iter_messages():
+        nonlocal export_error
+        try:
+            yield from iter_messages_with_progress(json_file_path, "Составление плана")
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            export_error = e
+
+    for message in iter_messages():
+        message_id = message.get("id")
+        if isinstance(message_id, int) and watermark is not None:
+            if message_id <= watermark:
+                continue
+        record = parse_message(message)
+        entries = []
+        for url, kind in record.urls:
+            url = canonicalize_url(url)
+            if kind == LINK_SKIP:
+                if url not in seen_skipped:
+                    seen_skipped.add(url)
+                    skipped.append(format_link(record.month, url))
+                continue
+            if not record.month:
+                continue
+            entry = {
+                "url": url,
+                "host": urlparse(url).hostname,
+                "kind": kind,
+                "status": "download",
+                "name": None,
+                "size": None,
+            }
+            entries.append(entry)
+            if url in seen:
+                entry["status"] = "repeat"
+                continue
+            seen.add(url)
+            if manifest and manifest.is_done(url, record.id):
+                entry["status"] = "cached"
+                continue
+
+            def task(entry=entry, message_id=record.id):
+                name, size, error = estimate_link(entry["url"], message_id)
+                entry.update(name=name, size=size)
+                if should_ignore_file(name):
+                    entry["status"] = "ignored"
+                # Ссылка, которую не удалось оценить, не входит в объем
+                # плана: при скачивании она, скорее всего, тоже не скачается
+                if error:
+                    entry.update(status="error", error=error)
+
+            scheduler.submit(urlparse(url).netloc.lower(), task)
+
+        if entries:
+            messages.append(
+                {
+                    "id": record.id,
+                    "date": record.date,
+                    "text_entities": [
+                        {"type": "link", "text": entry["url"]} for entry in entries
+                    ],
+                    "plan": entries,
+                }
+            )
+    scheduler.join()
+    if manifest:
+        manifest.close()
+    if export_error:
+        print(
+            f"Ошибка: Не удалось прочитать JSON-файл '{json_file_path}'. "
+            "Проверьте его формат."
+        )
+        print(f"План составлен по сообщениям до места ошибки ({export_error})")
+
+    summary = _plan_summary(json_file_path, target_dir, messages, skipped)
+    plan = {**header, "messages": messages, "plan": summary}
+    temp_path = plan_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(plan, f, ensure_ascii=False, indent=1)
+    os.replace(temp_path, plan_path)
+
+    _print_plan_summary(summary)
+    print(f"План сохранен в файл: {plan_path}")
+    print(
+        f"Выполнить план: --source_file {plan_path} --target_dir {target_dir} "
+        "--download"
+    )
+    return summary
+
+
+def _plan_summary(json_file_path, target_dir, messages, skipped):
+    # Сводка плана: число ссылок по статусам и оценка объема по хостам
+    # и месяцам (для ссылок, которые будут скачаны)
+    statuses = {}
+    hosts = {}
+    months = {}
+    for message in messages:
+        month = datetime.fromisoformat(message["date"]).strftime("%Y-%m")
+        for entry in message["plan"]:
+            statuses[entry["status"]] = statuses.get(entry["status"], 0) + 1
+            if entry["status"] != "download":
+                continue
+            for totals, key in ((hosts, entry["host"]), (months, month)):
+                item = totals.setdefault(key, {"links": 0, "bytes": 0, "unknown": 0})
+                item["links"] += 1
+                item["bytes"] += entry["size"] or 0
+                item["unknown"] += entry["size"] is None
+    return {
+        "export": os.path.abspath(json_file_path),
+        "target_dir": os.path.abspath(target_dir),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "links": statuses,
+        "bytes": sum(item["bytes"] for item in hosts.values()),
+        "unknown": sum(item["unknown"] for item in hosts.values()),
+        "hosts": dict(sorted(hosts.items(), key=lambda h: -h[1]["bytes"])),
+        "months": dict(sorted(months.items())),
+        "skipped": skipped,
+    }
+
+
+def _print_plan_summary(summary):
+    print("\n--- План скачивания ---")
+    for title, key in (("Хост", "hosts"), ("Месяц", "months")):
+        rows = [(title, "ссылок", "объем", "без размера")]
+        for name, item in summary[key].items():
+            size = format_file_size(item["bytes"])
+            rows.append((name, str(item["links"]), size, str(item["unknown"])))
+        widths = [max(len(row[i]) for row in rows) for i in range(4)]
+        for row in rows:
+            line = "  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+            print(line.rstrip())
+        print()
+    statuses = summary["links"]
+    print(
+        f"Будет скачано ссылок: {statuses.get('download', 0)}, примерно "
+        f"{format_file_size(summary['bytes'])} (без размера: {summary['unknown']})"
+    )
+    if any(statuses.get(status) for status in ("repeat", "cached", "ignored")):
+        print(
+            f"Повторы: {statuses.get('repeat', 0)}, скачаны ранее: "
+            f"{statuses.get('cached', 0)}, игнорируются: {statuses.get('ignored', 0)}"
+        )
+    if statuses.get("error"):
+        print(
+            f"Не удалось оценить (ошибка запроса, в объем не входят): "
+            f"{statuses['error']}"
+        )
+    if summary["skipped"]:
+        print(f"Будут пропущены (соцсети, видеохостинги): {len(summary['skipped'])}")
+
+
+# Имя файла со сводкой пакетной обработки
+BATCH_SUMMARY_FILENAME = "batch_summary.json"
+
+# Имя файла, в который пишется вывод обработки одного экспорта в пакете
+BATCH_LOG_FILENAME = "run.log"
+
+
+def find_exports(patterns):
+    """
+    Находит экспорты по списку путей и glob-шаблонов. Каждый путь - папка
+    экспорта с result.json или сам JSON-файл. Возвращает отсортированный
+    список путей к JSON-файлам без повторов.
+    """
+    found = set()
+    for pattern in patterns:
+        for path in glob.glob(os.path.expanduser(pattern)) or [pattern]:
+            if os.path.isdir(path):
+                path = os.path.join(path, "result.json")
+            if os.path.isfile(path):
+                found.add(os.path.abspath(path))
+    return sorted(found)
+
+
+def _batch_targets(json_paths, target_dir):
+    # Папка результатов каждого экспорта: имя папки экспорта, при
+    # совпадении имен - с номером
+    targets = []
+    used = set()
+    for path in json_paths:
+        name = os.path.basename(os.path.dirname(path))
+        unique, counter = name, 1
+        while unique in used:
+            counter += 1
+            unique = f"{name}_{counter}"
+        used.add(unique)
+        targets.append(os.path.join(target_dir, unique))
+    return targets
+
+
+def _init_batch_worker(budget, http_config, url_rules):
+    # Процесс пакетной обработки получает настройки HTTP и правила ссылок
+    # родителя и общий бюджет скачиваний
+    global _download_budget
+    _download_budget = budget
+    configure_http(**http_config)
+    configure_url_rules(url_rules)
+
+
+def _process_export(json_path, target_dir, options):
+    # Обрабатывает один экспорт в процессе пакетной обработки. Вывод
+    # пишется в журнал в папке результатов, чтобы не смешиваться с
+    # выводом других процессов
+    os.makedirs(target_dir, exist_ok=True)
+    started = time.monotonic()
+    with open(
+        os.path.join(target_dir, BATCH_LOG_FILENAME), "w", encoding="utf-8"
+    ) as log:
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            summary = find_and_process_files(json_path, target_dir, **options)
+    return summary, time.monotonic() - started
+
+
+def run_batch(
+    json_paths,
+    target_dir,
+    workers=None,
+    jobs=DEFAULT_JOBS,
+    url_rules=None,
+    **options,
+):
+    """
+    Обрабатывает несколько экспортов параллельно в пуле процессов.
+
+    Результаты каждого экспорта сохраняются в target_dir/<имя папки
+    экспорта>, вывод - в run.log там же. Все процессы используют одни
+    настройки HTTP (configure_http) и общий бюджет из jobs одновременных
+    скачиваний. Сводка по экспортам печатается и сохраняется в
+    batch_summary.json.
+
+    Args:
+        json_paths: пути к JSON-файлам экспортов (find_exports)
+        target_dir: общая целевая директория
+        workers: число процессов (по умолчанию - по числу ядер)
+        jobs: общее число одновременных скачиваний во всех процессах
+        url_rules: правила классификации ссылок (load_url_rules)
+        options: остальные параметры find_and_process_files
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(json_paths)))
+    targets = _batch_targets(json_paths, target_dir)
+    budget = multiprocessing.BoundedSemaphore(max(1, jobs))
+    print(
+        f"Экспортов: {len(json_paths)}, процессов: {workers}, "
+        f"скачиваний одновременно: {jobs}"
+    )
+
+    results = []
+    started = time.monotonic()
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_batch_worker,
+        initargs=(budget, dict(_http_config), url_rules),
+    ) as pool:
+        futures = {
+            pool.submit(_process_export, path, target, {**options, "jobs": jobs}): (
+                path,
+                target,
+            )
+            for path, target in zip(json_paths, targets)
+        }
+        for future in as_completed(futures):
+            path, target = futures[future]
+            result = {"export": path, "target": target}
+            try:
+                summary, seconds = future.result()
+            except Exception as e:
+                result.update(status="error", error=str(e))
+                print(f"✗ {path}: {e}")
+            else:
+                if summary is None:
+                    result.update(status="error", error="экспорт не прочитан")
+                    print(
+                        f"✗ {path}: экспорт не прочитан, "
+                        f"см. {target}/{BATCH_LOG_FILENAME}"
+                    )
+                else:
+                    result.update(
+                        status="ok",
+                        seconds=round(seconds, 3),
+                        counters=summary["counters"],
+                        bytes=sum(m["bytes"] for m in summary["hosts"].values()),
+                    )
+                    print(f"✓ {path} ({seconds:.1f} с)")
+            results.append(result)
+
+    results.sort(key=lambda r: r["export"])
+    totals = {}
+    for result in results:
+        for name, value in result.get("counters", {}).items():
+            totals[name] = totals.get(name, 0) + value
+    batch_summary = {
+        "exports": results,
+        "failed": sum(r["status"] != "ok" for r in results),
+        "bytes": sum(r.get("bytes", 0) for r in results),
+        "seconds": round(time.monotonic() - started, 3),
+        "totals": totals,
+    }
+    _print_batch_summary(batch_summary)
+    summary_path = os.path.join(target_dir, BATCH_SUMMARY_FILENAME)
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(batch_summary, f, ensure_ascii=False, indent=2)
+    print(f"Сводка сохранена в файл: {summary_path}")
+    return batch_summary
+
+
+def _print_batch_summary(batch_summary):
+    columns = [
+        ("messages", "сообщ."),
+        ("links", "ссылок"),
+        ("attachments", "влож."),
+        ("downloads_done", "скачано"),
+        ("already_done", "ранее"),
+        ("downloads_failed", "ошибок"),
+    ]
+    rows = [["экспорт"] + [title for _, title in columns] + ["время, с"]]
+    for result in batch_summary["exports"]:
+        name = os.path.basename(result["target"])
+        if result["status"] != "ok":
+            rows.append([name] + ["—"] * len(columns) + [result["error"]])
+            continue
+        counters = result["counters"]
+        rows.append(
+            [name]
+            + [str(counters.get(key, 0)) for key, _ in columns]
+            + [f"{result['seconds']:.1f}"]
+        )
+    totals = batch_summary["totals"]
+    rows.append(
+        ["итого"]
+        + [str(totals.get(key, 0)) for key, _ in columns]
+        + [f"{batch_summary['seconds']:.1f}"]
+    )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    print("\n--- Сводка по экспортам ---")
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+    print(f"Получено по HTTP: {format_file_size(batch_summary['bytes'])}")
+    if batch_summary["failed"]:
+        print(f"Экспортов с ошибками: {batch_summary['failed']}")
+
+
+# Как часто (секунды) проверять папку с экспортами в режиме наблюдения
+DEFAULT_WATCH_INTERVAL = 60
+
+
+def watch_exports(source_root, target_dir, interval=DEFAULT_WATCH_INTERVAL, **options):
+    """
+    Следит за папкой source_root и обрабатывает каждый новый экспорт
+    (подпапку с result.json) в инкрементальном режиме: из него берутся
+    только сообщения, появившиеся после прошлой обработки того же чата.
+
+    При запуске обрабатывается самый свежий из уже лежащих экспортов,
+    остальные считаются обработанными. Новый экспорт берется в работу,
+    когда размер result.json перестает меняться между проверками
+    (Telegram Desktop закончил запись). Останавливается по Ctrl+C.
+
+    options - остальные параметры find_and_process_files.
+    """
+    pattern = os.path.join(source_root, "*")
+
+    def sizes():
+        result = {}
+        for path in find_exports([pattern]):
+            try:
+                result[path] = (os.path.getmtime(path), os.path.getsize(path))
+            except OSError:
+                continue
+        return result
+
+    # Размеры с прошлой проверки: экспорт обрабатывается, когда его размер
+    # совпал с прошлым. Уже лежащие экспорты, кроме самого свежего,
+    # пропускаются
+    previous = sizes()
+    seen = set(sorted(previous, key=lambda p: previous[p][0])[:-1])
+    print(f"Наблюдение за {source_root}: проверка каждые {interval} с, Ctrl+C - выход")
+    try:
+        while True:
+            current = sizes()
+            for path in sorted(current, key=lambda p: current[p][0]):
+                if path in seen or current[path][1] != previous.get(path, (0, None))[1]:
+                    continue
+                seen.add(path)
+                print(f"\nНовый экспорт: {path}")
+                try:
+                    find_and_process_files(
+                        path, target_dir, incremental=True, **options
+                    )
+                except Exception as e:
+                    print(f"Ошибка обработки экспорта {path}: {e}")
+            previous = current
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\nНаблюдение остановлено")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Telegram Chat Export Downloader - скачивает файлы и собирает ссылки из экспорта Telegram"
@@ -604,12 +4744,67 @@ def main():
 
     parser.add_argument("--no-links", action="store_true", help="Отключить сбор ссылок")
 
+    parser.add_argument(
+        "--no-txt",
+        action="store_true",
+        help=f"Не создавать links.txt, skipped.txt и errors.txt: ссылки и "
+        f"результаты есть в индексе {LINK_INDEX_FILENAME}",
+    )
+
     parser.add_argument("--source_file", type=str, help="Путь к JSON файлу с экспортом")
 
     parser.add_argument(
         "--source_dir", type=str, help="Директория, где искать result.json"
     )
 
+    parser.add_argument(
+        "--batch",
+        nargs="+",
+        metavar="PATH",
+        help="Обработать несколько экспортов параллельно: папки экспортов, "
+        "JSON-файлы или glob-шаблоны (например, 'archive/ChatExport_*'). "
+        "Результаты каждого - в target_dir/<имя папки экспорта>",
+    )
+
+    parser.add_argument(
+        "--batch-workers",
+        type=int,
+        default=None,
+        help="Число процессов пакетной обработки (по умолчанию: по числу ядер)",
+    )
+
+    parser.add_argument(
+        "--plan",
+        type=str,
+        metavar="PLAN_FILE",
+        help="Не скачивать, а составить план: оценить объем по хостам и "
+        "месяцам и сохранить план в файл. Выполнить его: "
+        "--source_file PLAN_FILE --download",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Обрабатывать только сообщения, появившиеся после прошлого запуска "
+        f"для этого чата (отметка хранится в {MANIFEST_FILENAME})",
+    )
+
+    parser.add_argument(
+        "--watch",
+        type=str,
+        metavar="SOURCE_ROOT",
+        help="Следить за папкой с экспортами и обрабатывать каждый новый "
+        "экспорт в инкрементальном режиме",
+    )
+
+    parser.add_argument(
+        "--watch-interval",
+        type=int,
+        default=DEFAULT_WATCH_INTERVAL,
+        help="Как часто проверять папку --watch, секунд "
+        f"(по умолчанию: {DEFAULT_WATCH_INTERVAL})",
+    )
+
     parser.add_argument(
         "--target_dir",
         type=str,
@@ -617,6 +4812,136 @@ def main():
         help="Целевая директория для сохранения файлов (по умолчанию: results)",
     )
 
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"Число одновременных скачиваний (по умолчанию: {DEFAULT_JOBS})",
+    )
+
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=DEFAULT_PER_HOST_JOBS,
+        help="Максимум одновременных скачиваний с одного хоста "
+        f"(по умолчанию: {DEFAULT_PER_HOST_JOBS})",
+    )
+
+    parser.add_argument(
+        "--no-manifest",
+        action="store_true",
+        help=f"Не использовать {MANIFEST_FILENAME}: скачивать все ссылки заново",
+    )
+
+    parser.add_argument(
+        "--dedup",
+        choices=DEDUP_MODES,
+        default=None,
+        help="Связывать одинаковые по содержимому файлы жесткой ссылкой "
+        "или reflink-копией вместо хранения копий",
+    )
+
+    parser.add_argument(
+        "--attachments-mode",
+        choices=ATTACHMENT_MODES,
+        default="copy",
+        help="Как переносить вложения из экспорта: копировать или связывать "
+        "ссылками (по умолчанию: copy)",
+    )
+
+    parser.add_argument(
+        "--copy-jobs",
+        type=int,
+        default=DEFAULT_COPY_JOBS,
+        help=f"Число потоков копирования вложений (по умолчанию: {DEFAULT_COPY_JOBS})",
+    )
+
+    parser.add_argument(
+        "--url-rules",
+        type=str,
+        default=None,
+        help="JSON-файл с правилами классификации ссылок (skip_domains, "
+        "html_domains, yandex_domains, file_extensions и др.)",
+    )
+
+    parser.add_argument(
+        "--title-bytes",
+        type=int,
+        default=TITLE_SCAN_BYTES,
+        help=f"Сколько первых байт HTML-страницы читать в поисках <title> "
+        f"(по умолчанию {TITLE_SCAN_BYTES})",
+    )
+
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help=f"Сколько раз повторять запрос при временной ошибке: сеть, "
+        f"429, 5xx (по умолчанию {DEFAULT_RETRIES})",
+    )
+
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=DEFAULT_CONNECT_TIMEOUT,
+        help="Таймаут установки соединения, секунд "
+        f"(по умолчанию {DEFAULT_CONNECT_TIMEOUT})",
+    )
+
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=DEFAULT_READ_TIMEOUT,
+        help=f"Таймаут ожидания данных, секунд (по умолчанию {DEFAULT_READ_TIMEOUT})",
+    )
+
+    parser.add_argument(
+        "--segments",
+        type=int,
+        default=DEFAULT_SEGMENTS,
+        help=f"На сколько частей делить большие файлы при скачивании, если "
+        f"сервер поддерживает Range; 1 - без деления (по умолчанию {DEFAULT_SEGMENTS})",
+    )
+
+    parser.add_argument(
+        "--max-age",
+        type=int,
+        default=None,
+        help="Перепроверять ранее скачанные ссылки, если с прошлой проверки "
+        "прошло больше стольких секунд (условный запрос без скачивания тела; "
+        "0 - всегда). По умолчанию не перепроверять",
+    )
+
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=None,
+        help="Сколько записей кэша ревалидации хранить в манифесте "
+        "(вытесняются давно не использованные)",
+    )
+
+    parser.add_argument(
+        "--metrics-prom",
+        type=str,
+        default=None,
+        help="Файл для метрик в формате Prometheus textfile "
+        "(например, для node_exporter)",
+    )
+
+    parser.add_argument(
+        "--user-agent",
+        type=str,
+        default=DEFAULT_USER_AGENT,
+        help="Заголовок User-Agent для HTTP-запросов",
+    )
+
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=None,
+        help="Размер пула соединений на один хост (по умолчанию: равен --per-host)",
+    )
+
     args = parser.parse_args()
 
     # Определяем путь к JSON файлу
@@ -626,16 +4951,28 @@ def main():
         json_file_path = args.source_file
     elif args.source_dir:
         json_file_path = os.path.join(args.source_dir, "result.json")
-    else:
-        # По умолчанию ищем в текущей директории
-        default_paths = ["source/ChatExport_2025-06-08/result.json", "result.json"]
-        for path in default_paths:
+    elif not args.batch and not args.watch:
+        # По умолчанию ищем последний экспорт в source/ или result.json
+        # в текущей директории
+        default_paths = sorted(glob.glob("source/ChatExport_*/result.json"))[-1:]
+        for path in default_paths + ["result.json"]:
             if os.path.exists(path):
                 json_file_path = path
                 break
 
     # Проверяем, что файл найден
-    if not json_file_path or not os.path.exists(json_file_path):
+    batch_paths = find_exports(args.batch) if args.batch else None
+    if args.batch and not batch_paths:
+        print("Ошибка: по --batch не найдено ни одного экспорта с result.json!")
+        return
+    if args.watch and not os.path.isdir(args.watch):
+        print(f"Ошибка: папка '{args.watch}' для --watch не найдена!")
+        return
+    if (
+        not args.batch
+        and not args.watch
+        and (not json_file_path or not os.path.exists(json_file_path))
+    ):
         print("Ошибка: JSON файл с экспортом не найден!")
         print("Используйте:")
         print("  --source_file путь/к/файлу.json")
@@ -647,17 +4984,103 @@ def main():
     collect_links = args.links and not args.no_links
     download_files = args.download
 
-    print(f"Исходный файл: {json_file_path}")
+    if batch_paths:
+        print(f"Экспорты: {len(batch_paths)}")
+    elif args.watch:
+        print(f"Папка с экспортами: {args.watch}")
+    else:
+        print(f"Исходный файл: {json_file_path}")
     print(f"Целевая директория: {args.target_dir}")
     print(f"Сбор ссылок: {'включен' if collect_links else 'отключен'}")
     print(f"Скачивание файлов: {'включено' if download_files else 'отключено'}")
 
+    url_rules = None
+    if args.url_rules:
+        try:
+            url_rules = load_url_rules(args.url_rules)
+            configure_url_rules(url_rules)
+        except (OSError, ValueError) as e:
+            print(
+                f"Ошибка: не удалось загрузить правила ссылок '{args.url_rules}': {e}"
+            )
+            return
+
+    # Настраиваем общую HTTP-сессию: соединений на хост не меньше,
+    # чем одновременных скачиваний с него (с учетом частей файла)
+    segments = max(1, args.segments)
+    configure_http(
+        user_agent=args.user_agent,
+        pool_maxsize=args.pool_size
+        or max(args.per_host * segments, DEFAULT_POOL_MAXSIZE),
+        title_bytes=args.title_bytes,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        retries=args.retries,
+        segments=segments,
+    )
+
+    options = dict(
+        download_files=download_files,
+        collect_links=collect_links,
+        jobs=args.jobs,
+        per_host_jobs=args.per_host,
+        use_manifest=not args.no_manifest,
+        dedup=args.dedup,
+        attachments_mode=args.attachments_mode,
+        copy_jobs=args.copy_jobs,
+        max_age=args.max_age,
+        cache_size=args.cache_size,
+        text_views=not args.no_txt,
+        incremental=args.incremental,
+    )
+
     # Запускаем обработку
+    if args.plan:
+        if batch_paths or args.watch:
+            print("Ошибка: --plan составляется для одного экспорта")
+            return
+        plan_downloads(
+            json_file_path,
+            args.target_dir,
+            args.plan,
+            jobs=args.jobs,
+            per_host_jobs=args.per_host,
+            use_manifest=not args.no_manifest,
+            incremental=args.incremental,
+        )
+        return
+
+    if args.watch:
+        options.pop("incremental")
+        watch_exports(
+            args.watch,
+            args.target_dir,
+            interval=args.watch_interval,
+            prometheus_file=args.metrics_prom,
+            **options,
+        )
+        return
+
+    if batch_paths:
+        if args.metrics_prom:
+            print(
+                "--metrics-prom в пакетном режиме не используется: метрики "
+                "каждого экспорта сохраняются в его metrics.json"
+            )
+        run_batch(
+            batch_paths,
+            args.target_dir,
+            workers=args.batch_workers,
+            url_rules=url_rules,
+            **options,
+        )
+        return
+
     find_and_process_files(
         json_file_path,
         args.target_dir,
-        download_files=download_files,
-        collect_links=collect_links,
+        prometheus_file=args.metrics_prom,
+        **options,
     )
 
 
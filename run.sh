@@ -28,6 +28,8 @@ show_help() {
     echo "  --source_file      📄 Путь к JSON файлу с экспортом"
     echo "  --source_dir       📁 Директория где искать result.json"
     echo "  --target_dir       💾 Целевая директория (по умолчанию: results)"
+    echo "  --jobs N           ⚡ Одновременных скачиваний (по умолчанию: 4)"
+    echo "  --per-host N       🌐 Скачиваний с одного хоста (по умолчанию: 2)"
     echo ""
     echo "📊 Результаты:"
     echo "  links.txt          - Все найденные ссылки"
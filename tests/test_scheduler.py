@@ -0,0 +1,54 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import downloader  # noqa: E402
+
+
+def run_nested(jobs, per_host_jobs, folders=1, files=5):
+    # Задачи-"папки" запускают вложенные задачи через TaskGroup, как
+    # download_yandex_folder
+    scheduler = downloader.DownloadScheduler(jobs, per_host_jobs)
+    done = []
+    lock = threading.Lock()
+
+    def folder(number):
+        current, host = downloader.DownloadScheduler.current()
+        group = downloader.TaskGroup(current, host, current.per_host_jobs * 4)
+        for index in range(files):
+
+            def task(index=index):
+                with lock:
+                    done.append((number, index))
+
+            group.submit(task)
+        group.join()
+
+    for number in range(folders):
+        scheduler.submit("disk.yandex.ru", lambda number=number: folder(number))
+
+    finished = threading.Event()
+
+    def join():
+        scheduler.join()
+        finished.set()
+
+    threading.Thread(target=join, daemon=True).start()
+    assert finished.wait(10), "планировщик завис на вложенных задачах"
+    return done
+
+
+def test_nested_group_single_worker():
+    assert len(run_nested(jobs=1, per_host_jobs=2)) == 5
+
+
+def test_nested_groups_fewer_workers_than_host_limit():
+    assert len(run_nested(jobs=2, per_host_jobs=4, folders=3, files=20)) == 60
+
+
+def test_nested_groups_with_batch_budget(monkeypatch):
+    # Общий бюджет пакетной обработки занят задачами-папками
+    monkeypatch.setattr(downloader, "_download_budget", threading.BoundedSemaphore(1))
+    assert len(run_nested(jobs=3, per_host_jobs=3, folders=2, files=10)) == 20